@@ -6,6 +6,8 @@ from typing import List, Dict, Optional
 
 from settings import settings
 import db
+import rules_engine
+import broadcast
 
 API_BASE = f"https://api.telegram.org/bot{settings.BOT_TOKEN}"
 
@@ -25,9 +27,16 @@ async def close_http():
         await _session.close()
         _session = None
 
+# После 429 все запросы бота ждут до этого момента (monotonic), а не только упавший
+_FLOOD_UNTIL = 0.0
+
 async def _api_post(method: str, data: Dict) -> Dict:
+    global _FLOOD_UNTIL
     if _session is None:
         await init_http()
+    wait = _FLOOD_UNTIL - time.monotonic()
+    if wait > 0:
+        await asyncio.sleep(wait)
     async with _session.post(f"{API_BASE}/{method}", json=data, timeout=20) as r:
         try:
             resp = await r.json()
@@ -44,12 +53,14 @@ async def _api_post(method: str, data: Dict) -> Dict:
                     retry = int(params["retry_after"])
                 except Exception:
                     pass
+            _FLOOD_UNTIL = max(_FLOOD_UNTIL, time.monotonic() + retry + 0.05)
             await db.log("WARN", f"Flood wait {retry}s on {method}")
             await asyncio.sleep(retry + 0.05)
         return resp
 
 # ========= РЕЙТ-КОНТРОЛЬ =========
 GLOBAL_RPS = 25
+PER_CHAT_INTERVAL = 1.0  # 1 msg/sec в чат
 _PER_CHAT_LAST: dict[int, float] = {}
 _GLOBAL_LAST = 0.0
 
@@ -59,11 +70,12 @@ async def _rate_limit(chat_id: int | None = None):
     wait = max(0.0, _GLOBAL_LAST + 1.0 / GLOBAL_RPS - now)
     if chat_id is not None:
         last = _PER_CHAT_LAST.get(chat_id, 0.0)
-        wait = max(wait, last + 1.0 - now)  # 1 msg/sec в чат
+        wait = max(wait, last + PER_CHAT_INTERVAL - now)
         _PER_CHAT_LAST[chat_id] = now + wait
+    # слот резервируем до сна — параллельные отправки (burst) получают следующие слоты
+    _GLOBAL_LAST = now + wait
     if wait > 0:
         await asyncio.sleep(wait)
-    _GLOBAL_LAST = now + wait
 
 # ========= ИНТЕРВАЛЫ ОПРОСА (ТУРБО) =========
 POLL_BASE_INTERVAL = 10.0
@@ -85,6 +97,26 @@ def turbo_remaining() -> int:
 def current_poll_interval() -> float:
     return POLL_TURBO_INTERVAL if turbo_remaining() > 0 else POLL_BASE_INTERVAL
 
+def reset_runtime_state() -> None:
+    """Обнуляет лимитер, flood-gate и турбо — чистый старт (офлайн-реплей)."""
+    global _GLOBAL_LAST, _FLOOD_UNTIL, _TURBO_UNTIL
+    _GLOBAL_LAST = _FLOOD_UNTIL = _TURBO_UNTIL = 0.0
+    _PER_CHAT_LAST.clear()
+
+# Несколько инстансов (HA): команда могла прийти на standby, а опрашивает лидер —
+# поэтому интервал и турбо дублируются в общую БД и подтягиваются оттуда
+async def publish_poll_settings() -> None:
+    turbo_until = _TURBO_UNTIL - time.monotonic() + time.time() if _TURBO_UNTIL else 0.0
+    await db.set_runtime(poll_base=POLL_BASE_INTERVAL, turbo_until=turbo_until)
+
+async def sync_poll_settings() -> None:
+    global _TURBO_UNTIL
+    vals = await db.get_runtime("poll_base", "turbo_until")
+    if "poll_base" in vals:
+        set_base_interval(vals["poll_base"])
+    if vals.get("turbo_until"):
+        _TURBO_UNTIL = vals["turbo_until"] - time.time() + time.monotonic()
+
 # ========= УТИЛИТЫ ПАРСИНГА КАТАЛОГА =========
 def _to_int_or_none(v) -> Optional[int]:
     try:
@@ -118,39 +150,66 @@ async def fetch_available_gifts() -> List[Dict]:
         if not resp.get("ok"):
             await db.log("WARN", f"getAvailableGifts not ok: {resp}")
             return []
-        res = resp.get("result") or {}
-        items = res.get("gifts") if isinstance(res, dict) else (res or [])
-        normalized = []
-        for it in items:
-            normalized.append({
-                "id": it.get("id"),
-                # используем эмодзи как короткий "титул" (в ответе нет названия)
-                "title": (it.get("sticker", {}) or {}).get("emoji", "") or "Gift",
-                "price": int(it.get("star_count", 0)),
-                # этих полей нет в API — оставляем служебно пустыми
-                "limited": False,
-                "supply": None,
-            })
-        return normalized
+        return normalize_gifts(resp)
     except Exception as e:
         await db.log("WARN", f"getAvailableGifts failed: {e}")
         return []
 
 
-async def send_gift(to_user_id: int, gift_id: str, text: str = "") -> bool:
+def normalize_gifts(resp: dict) -> List[Dict]:
+    """Ответ getAvailableGifts -> список {id, title, price, limited, supply, total}."""
+    res = resp.get("result") or {}
+    items = res.get("gifts") if isinstance(res, dict) else (res or [])
+    normalized = []
+    for it in items:
+        # у лимитных Bot API отдаёт total_count/remaining_count
+        supply = _extract_supply(it)
+        normalized.append({
+            "id": it.get("id"),
+            # используем эмодзи как короткий "титул" (в ответе нет названия)
+            "title": (it.get("sticker", {}) or {}).get("emoji", "") or "Gift",
+            "price": int(it.get("star_count", 0)),
+            "limited": _is_limited(it, supply) or it.get("total_count") is not None,
+            "supply": supply,
+            "total": _to_int_or_none(it.get("total_count")),
+        })
+    return normalized
+
+
+# Итог отправки подарка
+SEND_OK = "ok"
+SEND_SOLD_OUT = "sold_out"        # лимитка закончилась
+SEND_NO_BALANCE = "no_balance"    # у бота не хватает звёзд
+SEND_FAILED = "failed"
+
+_SOLD_OUT_MARKERS = ("USAGE_LIMITED", "SOLD_OUT", "SOLD OUT")
+_NO_BALANCE_MARKERS = ("BALANCE_TOO_LOW", "NOT ENOUGH", "INSUFFICIENT")
+
+def _classify_send_error(resp: dict) -> str:
+    desc = str(resp.get("description", "")).upper()
+    if any(m in desc for m in _SOLD_OUT_MARKERS):
+        return SEND_SOLD_OUT
+    if any(m in desc for m in _NO_BALANCE_MARKERS):
+        return SEND_NO_BALANCE
+    return SEND_FAILED
+
+async def send_gift_status(to_user_id: int, gift_id: str, text: str = "") -> str:
     try:
         await _rate_limit(to_user_id)
         payload = {"user_id": to_user_id, "gift_id": str(gift_id)}
         if text:
             payload["text"] = text
         resp = await _api_post("sendGift", payload)
-        ok = bool(resp.get("ok"))
-        if not ok:
-            await db.log("WARN", f"sendGift failed: {resp}")
-        return ok
+        if resp.get("ok"):
+            return SEND_OK
+        await db.log("WARN", f"sendGift failed: {resp}")
+        return _classify_send_error(resp)
     except Exception as e:
         await db.log("WARN", f"sendGift error: {e}")
-        return False
+        return SEND_FAILED
+
+async def send_gift(to_user_id: int, gift_id: str, text: str = "") -> bool:
+    return await send_gift_status(to_user_id, gift_id, text) == SEND_OK
 
 # внизу рядом с fetch_available_gifts()
 async def fetch_available_gifts_raw() -> dict:
@@ -168,50 +227,237 @@ async def check_new_gifts_and_autobuy(bot) -> None:
     if not gifts:
         return
 
-    known_ids = await db.known_gift_ids()
-    await db.upsert_gifts_cache(gifts)
+    # дифф с кэшем + запись дельт (цена/остаток/появление/исчезновение) в журнал
+    new_ids, _ = await db.apply_catalog_snapshot(gifts)
 
     # "редкие" в текущем API трактуем как "новые" — их и так выбираем диффом
-    new_gifts = [g for g in gifts if str(g["id"]) not in known_ids]
+    new_gifts = [g for g in gifts if str(g["id"]) in new_ids]
     if not new_gifts:
         return
+    await handle_new_gifts(bot, new_gifts)
+
+
+# подарки, по которым сейчас идут покупки: id -> подарок (попадают в снапшот,
+# после рестарта посреди дропа докупаются через resume_drops)
+PENDING_DROPS: Dict[str, Dict] = {}
+
+async def handle_new_gifts(bot, new_gifts: List[Dict], already: Optional[Dict] = None) -> None:
+    """
+    Реакция на новые подарки: покупки по правилам, затем анонс подписчикам.
+    already — {(user_id, gift_id): копий}, уже отправленных до рестарта.
+    """
+    ids = [str(g["id"]) for g in new_gifts]
+    PENDING_DROPS.update((str(g["id"]), g) for g in new_gifts)
+    _purchases_begin()
+    started = False
+    try:
+        # отметка в общей БД: упадём посреди дропа — докупит новый лидер
+        await db.start_drops(new_gifts)
+        started = True
+        await db.log("INFO", f"{'Resumed' if already is not None else 'New'} gifts: {', '.join(ids)}")
+        # все правила всех пользователей проверяются векторно, с учётом бюджетов
+        decisions = await rules_engine.plan_purchases(new_gifts, already)
+        await execute_decisions(bot, decisions)
+    finally:
+        for gid in ids:
+            PENDING_DROPS.pop(gid, None)
+        if started:
+            try:
+                await db.finish_drops(ids)
+            except Exception:
+                pass    # отметка останется: докупка по ней ничего не повторит (purchased_copies)
+        _purchases_end()
+        # анонс — только после покупок и отдельной задачей: ни его запросы к БД,
+        # ни его ошибки не задерживают и не срывают sendGift
+        _spawn_announce(new_gifts)
+
+
+async def resume_drops(bot, gifts: List[Dict]) -> None:
+    """
+    Докупает дропы, прерванные рестартом или падением прежнего лидера.
+    Решения планируются заново; копии, которые уже есть в purchases,
+    вычитаются, баланс сторожит reserve_balance.
+    """
+    if not gifts:
+        return
+    try:
+        already = await db.purchased_copies([str(g["id"]) for g in gifts])
+        await handle_new_gifts(bot, gifts, already)
+    except Exception as e:
+        await db.log("WARN", f"resume of interrupted drop failed: {e}")
 
-    await db.log("INFO", f"New gifts: {', '.join(str(g['id']) for g in new_gifts)}")
 
-    users = await db.autobuy_users_with_rules()
-    if not users:
-        return
+_ANNOUNCE_TASKS: set[asyncio.Task] = set()
 
-    for g in new_gifts:
-        price = int(g["price"])
-        for row in users:
-            uid = int(row["user_id"])
-            bal = int(row["balance"])
-            min_price = int(row["min_price"])
-            max_price = int(row["max_price"])
+async def _announce(new_gifts: List[Dict]) -> None:
+    try:
+        await broadcast.announce(new_gifts)
+    except Exception as e:
+        try:
+            await db.log("WARN", f"announce failed: {e}")
+        except Exception:
+            pass
 
-            if price < min_price or price > max_price:
-                continue
-            if bal < price:
-                continue
+def _spawn_announce(new_gifts: List[Dict]) -> None:
+    t = asyncio.create_task(_announce(new_gifts))
+    _ANNOUNCE_TASKS.add(t)
+    t.add_done_callback(_ANNOUNCE_TASKS.discard)
 
-            ok = await send_gift(uid, str(g["id"]), text="🎁 Новый подарок!")
-            if ok:
-                await db.add_balance(uid, -price)
-                try:
-                    await bot.send_message(uid, f"🎁 Отправлен подарок: {g['title']} (−{price} ⭐)")
-                except Exception:
-                    pass
 
-            await asyncio.sleep(0)  # yield
+# ========= ПРИОРИТЕТ ПОКУПОК =========
+# Пока идут покупки, фоновые рассылки (broadcast.py) стоят и не занимают слоты лимитера
+_PURCHASES_ACTIVE = 0
+_PURCHASES_IDLE = asyncio.Event()
+_PURCHASES_IDLE.set()
+
+def _purchases_begin() -> None:
+    global _PURCHASES_ACTIVE
+    _PURCHASES_ACTIVE += 1
+    _PURCHASES_IDLE.clear()
+
+def _purchases_end() -> None:
+    global _PURCHASES_ACTIVE
+    _PURCHASES_ACTIVE = max(0, _PURCHASES_ACTIVE - 1)
+    if _PURCHASES_ACTIVE == 0:
+        _PURCHASES_IDLE.set()
+
+async def wait_purchases_idle() -> None:
+    await _PURCHASES_IDLE.wait()
+
+def purchases_active() -> bool:
+    return _PURCHASES_ACTIVE > 0
+
+
+# одновременно обрабатываемых решений; больше GLOBAL_RPS × latency смысла нет
+BURST_CONCURRENCY = 50
+
+
+class _BurstState:
+    """Общие флаги одного дропа: какие подарки кончились и не кончились ли звёзды у бота."""
+
+    def __init__(self):
+        self.sold_out: set[str] = set()
+        self.halted = False
+
+    def stopped(self, gift_id: str) -> bool:
+        return self.halted or gift_id in self.sold_out
 
 
+def _normalize_status(status) -> str:
+    # сторонние sender'ы могут возвращать просто bool
+    if status is True:
+        return SEND_OK
+    if status is False or status is None:
+        return SEND_FAILED
+    return status
+
+
+async def _burst_one(bot, d, sender, state: _BurstState) -> int:
+    g = d.gift
+    uid = d.user_id
+    gid = str(g["id"])
+    price = int(g["price"])
+
+    # резервируем звёзды сразу под все копии, неиспользованное вернём;
+    # резерв лежит в БД, так что после падения его вернёт refund_open_reservations
+    rid, reserved = await db.reserve_balance(uid, gid, price, d.copies)
+    sent = 0
+    try:
+        for _ in range(reserved):
+            if state.stopped(gid):
+                break
+            status = _normalize_status(await sender(uid, gid, "🎁 Новый подарок!"))
+            if status == SEND_OK:
+                sent += 1
+                await db.record_purchase(uid, gid, price, rid)
+                continue
+            if status == SEND_SOLD_OUT:
+                state.sold_out.add(gid)
+            elif status == SEND_NO_BALANCE:
+                state.halted = True
+            break
+    finally:
+        if rid:
+            await db.release_reservation(rid)
+
+    if sent and bot is not None:
+        try:
+            copies = f" ×{sent}" if sent > 1 else ""
+            await bot.send_message(uid, f"🎁 Отправлен подарок: {g['title']}{copies} (−{price * sent} ⭐)")
+        except Exception:
+            pass
+    return sent
+
+
+async def execute_decisions(bot, decisions, sender=None) -> list[int]:
+    """
+    Отправляет подарки по решениям движка правил одним пайплайном: решения
+    идут параллельно, копии внутри решения — подряд, слоты выдаёт _rate_limit
+    (глобальный и на чат). Баланс под все копии резервируется заранее.
+    Подарок, который кончился, больше никому не шлём; если у бота кончились
+    звёзды — останавливаем весь дроп.
+    sender(user_id, gift_id, text) -> статус SEND_* (или bool); по умолчанию
+    send_gift_status, симулятор подставляет свой. bot=None — без уведомлений.
+    Возвращает число отправленных копий по каждому решению; упавшее решение
+    (например, ошибка БД) считается как 0 и не мешает остальным.
+    """
+    sender = sender or send_gift_status
+    state = _BurstState()
+    sem = asyncio.Semaphore(BURST_CONCURRENCY)
+    errors: list[str] = []
+
+    async def _run(d):
+        async with sem:
+            try:
+                return await _burst_one(bot, d, sender, state)
+            except Exception as e:
+                errors.append(f"{d.user_id}:{d.gift['id']}: {e}")
+                return 0
+
+    results = list(await asyncio.gather(*(_run(d) for d in decisions)))
+
+    if decisions:
+        summary = ", ".join(
+            f"{d.user_id}:{d.gift['id']}×{n}/{d.copies}" for d, n in zip(decisions, results)
+        )
+        await db.log("INFO", f"Drop result: {summary}")
+        if errors:
+            await db.log("WARN", f"Drop errors: {'; '.join(errors)}")
+        if state.sold_out:
+            await db.log("INFO", f"Sold out during drop: {', '.join(sorted(state.sold_out))}")
+        if state.halted:
+            await db.log("WARN", "Drop halted: bot stars balance too low")
+    return results
+
+
+# ========= ЧИСТКА ЖУРНАЛА КАТАЛОГА =========
+JOURNAL_PRUNE_EVERY = 3600.0
+_JOURNAL_PRUNED_AT = 0.0
+
+async def maybe_prune_journal() -> None:
+    """Раз в час удаляет из catalog_journal записи старше JOURNAL_RETENTION_DAYS."""
+    global _JOURNAL_PRUNED_AT
+    if settings.JOURNAL_RETENTION_DAYS <= 0 or time.monotonic() - _JOURNAL_PRUNED_AT < JOURNAL_PRUNE_EVERY:
+        return
+    _JOURNAL_PRUNED_AT = time.monotonic()
+    before = int((time.time() - settings.JOURNAL_RETENTION_DAYS * 86400) * 1000)
+    n = await db.prune_catalog_journal(before)
+    if n:
+        await db.log("INFO", f"catalog_journal: pruned {n} rows older than {settings.JOURNAL_RETENTION_DAYS}d")
+
 # ========= WATCHER =========
+LAST_WATCHER_TICK: float | None = None  # monotonic; по нему loopmon ловит пропуски тиков
+
 async def watcher_loop(bot, stop_event: asyncio.Event) -> None:
+    global LAST_WATCHER_TICK
     await db.log("INFO", "Watcher started")
     while not stop_event.is_set():
+        LAST_WATCHER_TICK = time.monotonic()
         try:
+            if settings.HA_ENABLED:
+                await sync_poll_settings()
             await check_new_gifts_and_autobuy(bot)
+            await maybe_prune_journal()
         except Exception as e:
             await db.log("WARN", f"watcher iteration error: {e}")
         delay = current_poll_interval() + random.uniform(0, 0.2)
@@ -219,4 +465,5 @@ async def watcher_loop(bot, stop_event: asyncio.Event) -> None:
             await asyncio.wait_for(stop_event.wait(), timeout=delay)
         except asyncio.TimeoutError:
             pass
+    LAST_WATCHER_TICK = None
     await db.log("INFO", "Watcher stopped")
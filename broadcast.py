@@ -0,0 +1,161 @@
+"""
+Рассылка «вышел новый подарок» подписчикам (/subscribe).
+
+Каждый дроп — строка в broadcasts с курсором по user_id: после рестарта
+рассылка продолжается с места остановки. Подписчики читаются keyset-
+страницами, отправка идёт через общий autobuy._rate_limit (глобальный и
+на чат лимиты), а перед каждой отправкой ждём, пока закончатся покупки —
+анонсы никогда не отнимают слоты у sendGift. Заблокировавших бота помечаем
+users.blocked и больше им не пишем.
+"""
+import asyncio
+import logging
+import time
+from html import escape
+from typing import Optional, Sequence
+
+from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter
+
+import autobuy
+import db
+
+logger = logging.getLogger("giftbot.broadcast")
+
+PAGE_SIZE = 500          # подписчиков за один запрос к БД
+CONCURRENCY = 8          # одновременных send_message внутри страницы
+SAVE_EVERY = 100         # сохранять курсор каждые N обработанных
+RETRY_MIN = 5.0          # пауза после ошибки, дальше удваивается
+RETRY_MAX = 300.0
+
+
+def format_announcement(gifts: Sequence[dict]) -> str:
+    lines = ["🆕 Новые подарки:"]
+    for g in gifts:
+        extra = f", осталось {g['supply']}" if g.get("supply") is not None else ""
+        lines.append(f"• {escape(str(g.get('title') or 'Gift'))} — {int(g['price'])} ⭐{extra}")
+    return "\n".join(lines)
+
+
+async def announce(gifts: Sequence[dict]) -> Optional[int]:
+    """Ставит рассылку о новых подарках в очередь. None — подписчиков нет."""
+    if not gifts or await db.count_subscribers() == 0:
+        return None
+    bid = await db.create_broadcast(format_announcement(gifts))
+    broadcaster.wake()
+    return bid
+
+
+class Broadcaster:
+    def __init__(self):
+        self.bot = None
+        self._task: Optional[asyncio.Task] = None
+        self._wake = asyncio.Event()
+        # прогресс текущей рассылки
+        self.current: Optional[int] = None
+        self.started_at = 0.0
+        self.done_in_run = 0
+        self.paused_for_purchases = 0.0
+
+    def wake(self) -> None:
+        self._wake.set()
+
+    def start(self, bot) -> None:
+        self.bot = bot
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+            self.wake()   # вдруг после рестарта осталась недоделанная
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def rate(self) -> float:
+        """Доставок в секунду в текущей рассылке."""
+        elapsed = time.monotonic() - self.started_at
+        return self.done_in_run / elapsed if self.current and elapsed > 0 else 0.0
+
+    async def _run(self) -> None:
+        backoff = RETRY_MIN
+        while True:
+            await self._wake.wait()
+            self._wake.clear()
+            job = None
+            try:
+                while (job := await db.next_broadcast()) is not None:
+                    await self._deliver(job)
+                backoff = RETRY_MIN
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # курсор сохранён — повторим после паузы; ни ошибка БД, ни упавший
+                # db.log не должны убить задачу: start() её не перезапускает
+                where = f"broadcast #{job['id']}" if job is not None else "broadcast queue"
+                logger.warning("%s error: %s", where, e)
+                try:
+                    await db.log("WARN", f"{where} error: {e}")
+                except Exception:
+                    pass
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, RETRY_MAX)
+                self._wake.set()
+
+    async def _send(self, uid: int, text: str) -> str:
+        # покупки важнее: пока они идут, анонсы ждут
+        if autobuy.purchases_active():
+            t = time.monotonic()
+            await autobuy.wait_purchases_idle()
+            self.paused_for_purchases += time.monotonic() - t
+        await autobuy._rate_limit(uid)
+        try:
+            await self.bot.send_message(uid, text)
+            return "sent"
+        except TelegramForbiddenError:
+            return "blocked"
+        except TelegramRetryAfter as e:
+            await asyncio.sleep(e.retry_after + 0.05)
+            try:
+                await self.bot.send_message(uid, text)
+                return "sent"
+            except Exception:
+                return "failed"
+        except Exception:
+            return "failed"
+
+    async def _deliver(self, job) -> None:
+        bid, text, cursor = int(job["id"]), job["text"], int(job["cursor"])
+        self.current, self.started_at, self.done_in_run = bid, time.monotonic(), 0
+        sem = asyncio.Semaphore(CONCURRENCY)
+
+        async def one(uid: int) -> str:
+            async with sem:
+                return await self._send(uid, text)
+
+        try:
+            while True:
+                page = await db.subscribers_page(cursor, PAGE_SIZE)
+                if not page:
+                    break
+                for i in range(0, len(page), SAVE_EVERY):
+                    chunk = page[i:i + SAVE_EVERY]
+                    results = await asyncio.gather(*(one(u) for u in chunk))
+                    blocked = [u for u, r in zip(chunk, results) if r == "blocked"]
+                    if blocked:
+                        await db.mark_blocked(blocked)
+                    cursor = chunk[-1]
+                    await db.save_broadcast_progress(
+                        bid, cursor,
+                        sent=results.count("sent"), failed=results.count("failed"), blocked=len(blocked),
+                    )
+                    self.done_in_run += len(chunk)
+            await db.finish_broadcast(bid)
+            logger.info("broadcast #%d done: %d in %.1fs", bid, self.done_in_run, time.monotonic() - self.started_at)
+        finally:
+            self.current = None
+
+
+broadcaster = Broadcaster()
@@ -0,0 +1,109 @@
+"""
+Локальный стенд для пула юзер-аккаунтов (usergift_buy.BuyerPool): вместо
+TelegramClient — FakeClient, сеть и сессии не нужны.
+
+    python buyer_pool_bench.py --accounts 3 --copies 20 --flood-every 7
+    python buyer_pool_bench.py --accounts 2 --copies 10 --fail-after 2
+
+Печатает, сколько копий купили, как покупки легли по аккаунтам и сколько
+попыток стартовало уже после первой неудачи (их должно быть не больше
+суммарной ёмкости пула).
+"""
+import argparse
+import asyncio
+import time
+from typing import List, Optional
+
+from telethon.errors import FloodWaitError
+
+from usergift_buy import Buyer, BuyerPool
+
+
+class FakeClient:
+    """
+    Подмена TelegramClient: покупка занимает latency сек, каждая
+    flood_every-я отвечает FLOOD_WAIT, после fail_after успешных покупок
+    (общих на все клиенты стенда) — ошибка, как при распроданном подарке.
+        client = FakeClient("acc1", stars=1000)
+        Buyer(client, client.name, purchase=client.purchase_gift)
+    """
+
+    def __init__(self, name: str, stars: Optional[int] = None, latency: float = 0.05,
+                 flood_every: int = 0, flood_seconds: int = 3, shared: Optional[dict] = None):
+        self.name = name
+        self.stars = stars
+        self.latency = latency
+        self.flood_every = flood_every
+        self.flood_seconds = flood_seconds
+        self.shared = shared if shared is not None else {"sold": 0, "fail_after": 0, "failed_at": None, "late": 0}
+        self.calls = 0
+        self.bought: List[str] = []
+        self.sent: List[str] = []
+
+    async def connect(self):
+        return None
+
+    async def is_user_authorized(self) -> bool:
+        return True
+
+    async def send_message(self, entity, message, **kwargs):
+        self.sent.append(message)
+
+    async def purchase_gift(self, gift_id: str, price: int) -> None:
+        self.calls += 1
+        sh = self.shared
+        if sh["failed_at"] is not None:
+            sh["late"] += 1     # попытка стартовала уже после первой неудачи
+        await asyncio.sleep(self.latency)
+        if self.flood_every and self.calls % self.flood_every == 0:
+            raise FloodWaitError(request=None, capture=self.flood_seconds)
+        if sh["fail_after"] and sh["sold"] >= sh["fail_after"]:
+            if sh["failed_at"] is None:
+                sh["failed_at"] = time.perf_counter()
+            raise RuntimeError("SOLD_OUT")
+        if self.stars is not None:
+            if self.stars < price:
+                raise RuntimeError("BALANCE_TOO_LOW")
+            self.stars -= price
+        sh["sold"] += 1
+        self.bought.append(gift_id)
+
+
+async def bench(accounts: int, copies: int, in_flight: int, latency: float,
+                flood_every: int, fail_after: int) -> dict:
+    shared = {"sold": 0, "fail_after": fail_after, "failed_at": None, "late": 0}
+    clients = [
+        FakeClient(f"acc{i}", latency=latency, flood_every=flood_every, flood_seconds=1, shared=shared)
+        for i in range(accounts)
+    ]
+    pool = BuyerPool([Buyer(c, c.name, in_flight, purchase=c.purchase_gift) for c in clients])
+    started = time.perf_counter()
+    got = await pool.buy_copies("bench_gift", 10, copies)
+    return {
+        "copies": copies,
+        "bought": got,
+        "elapsed_s": time.perf_counter() - started,
+        "per_account": {c.name: len(c.bought) for c in clients},
+        "attempts": sum(c.calls for c in clients),
+        "late_attempts": shared["late"],
+        "pool_capacity": accounts * in_flight,
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser(description="BuyerPool bench on fake accounts")
+    ap.add_argument("--accounts", type=int, default=3)
+    ap.add_argument("--copies", type=int, default=20)
+    ap.add_argument("--in-flight", type=int, default=2)
+    ap.add_argument("--latency", type=float, default=0.05)
+    ap.add_argument("--flood-every", type=int, default=0, help="каждая N-я покупка аккаунта — FLOOD_WAIT")
+    ap.add_argument("--fail-after", type=int, default=0, help="после N покупок подарок «кончается»")
+    args = ap.parse_args()
+    res = asyncio.run(bench(args.accounts, args.copies, args.in_flight, args.latency,
+                            args.flood_every, args.fail_after))
+    for k, v in res.items():
+        print(f"{k:>14}: {v:.2f}" if isinstance(v, float) else f"{k:>14}: {v}")
+
+
+if __name__ == "__main__":
+    main()
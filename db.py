@@ -1,4 +1,6 @@
 import aiosqlite
+import sqlite3
+import time
 from contextlib import asynccontextmanager
 from pathlib import Path
 from typing import Iterable, Sequence
@@ -10,6 +12,12 @@ def _sqlite_path_from_url(url: str) -> str:
     return url.replace("sqlite:///", "", 1)
 
 _SQLITE_PATH = None
+# часы для меток покупок и «текущих суток» бюджетов; реплей подменяет на виртуальные
+_CLOCK = time.time
+
+def set_clock(clock=None) -> None:
+    global _CLOCK
+    _CLOCK = clock or time.time
 
 async def init_db(database_url: str) -> None:
     global _SQLITE_PATH
@@ -34,10 +42,57 @@ async def init_db(database_url: str) -> None:
               only_limited INTEGER NOT NULL DEFAULT 1,       -- 1 = покупать только лимитные
               min_price    INTEGER NOT NULL DEFAULT 0,       -- мин. цена ⭐
               max_price    INTEGER NOT NULL DEFAULT 1000000000, -- макс. цена ⭐
+              copies       INTEGER NOT NULL DEFAULT 1,       -- копий одного подарка за дроп
               updated_at   TEXT DEFAULT (datetime('now')),
               FOREIGN KEY(user_id) REFERENCES users(user_id) ON DELETE CASCADE
             );
 
+            /* Расширенные правила: у пользователя может быть несколько.
+               Если их нет — действует базовое правило из rules */
+            CREATE TABLE IF NOT EXISTS user_rules(
+              id           INTEGER PRIMARY KEY AUTOINCREMENT,
+              user_id      INTEGER NOT NULL,
+              min_price    INTEGER NOT NULL DEFAULT 0,
+              max_price    INTEGER NOT NULL DEFAULT 1000000000,
+              gift_id      TEXT,                          -- NULL = любой подарок
+              max_copies   INTEGER NOT NULL DEFAULT 1,    -- копий одного подарка
+              only_limited INTEGER NOT NULL DEFAULT 0,
+              daily_budget INTEGER,                       -- ⭐ в сутки (UTC), NULL = без лимита
+              drop_budget  INTEGER,                       -- ⭐ на один дроп, NULL = без лимита
+              updated_at   TEXT DEFAULT (datetime('now')),
+              FOREIGN KEY(user_id) REFERENCES users(user_id) ON DELETE CASCADE
+            );
+            CREATE INDEX IF NOT EXISTS idx_user_rules_user ON user_rules(user_id);
+
+            /* Отправленные автобаем подарки — для дневного бюджета и лимита копий */
+            CREATE TABLE IF NOT EXISTS purchases(
+              id          INTEGER PRIMARY KEY AUTOINCREMENT,
+              user_id     INTEGER NOT NULL,
+              gift_id     TEXT NOT NULL,
+              price       INTEGER NOT NULL,
+              fence       INTEGER,                      -- токен лиза, под которым куплено
+              ts          TEXT DEFAULT (datetime('now')),
+              FOREIGN KEY(user_id) REFERENCES users(user_id)
+            );
+            CREATE INDEX IF NOT EXISTS idx_purchases_user_ts ON purchases(user_id, ts);
+
+            /* Резервы звёзд под покупку: списаны заранее под copies копий, sent —
+               сколько уже отправлено. Открытый резерв после падения возвращается
+               (refund_open_reservations) */
+            CREATE TABLE IF NOT EXISTS reservations(
+              id          INTEGER PRIMARY KEY AUTOINCREMENT,
+              user_id     INTEGER NOT NULL,
+              gift_id     TEXT NOT NULL,
+              price       INTEGER NOT NULL,
+              copies      INTEGER NOT NULL,
+              sent        INTEGER NOT NULL DEFAULT 0,
+              fence       INTEGER,                      -- токен лиза, под которым зарезервировано
+              state       TEXT NOT NULL DEFAULT 'open', -- open / closed
+              ts          TEXT DEFAULT (datetime('now')),
+              FOREIGN KEY(user_id) REFERENCES users(user_id)
+            );
+            CREATE INDEX IF NOT EXISTS idx_reservations_open ON reservations(state) WHERE state='open';
+
             CREATE TABLE IF NOT EXISTS payments(
               id          INTEGER PRIMARY KEY AUTOINCREMENT,
               user_id     INTEGER NOT NULL,
@@ -55,6 +110,59 @@ async def init_db(database_url: str) -> None:
               added_at    TEXT DEFAULT (datetime('now'))
             );
 
+            /* Журнал изменений каталога: только дельты, всё целыми числами.
+               WITHOUT ROWID + PK (gift_id, ts) — ряд по подарку лежит подряд */
+            CREATE TABLE IF NOT EXISTS catalog_journal(
+              gift_id     TEXT NOT NULL,
+              ts          INTEGER NOT NULL,             -- unix ms
+              kind        INTEGER NOT NULL,             -- см. J_* ниже
+              price       INTEGER,
+              supply      INTEGER,
+              PRIMARY KEY (gift_id, ts, kind)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS idx_catalog_journal_ts ON catalog_journal(ts);
+
+            /* Рассылки о новых подарках: курсор = последний обработанный user_id */
+            CREATE TABLE IF NOT EXISTS broadcasts(
+              id          INTEGER PRIMARY KEY AUTOINCREMENT,
+              text        TEXT NOT NULL,
+              cursor      INTEGER NOT NULL DEFAULT 0,
+              total       INTEGER NOT NULL DEFAULT 0,
+              sent        INTEGER NOT NULL DEFAULT 0,
+              failed      INTEGER NOT NULL DEFAULT 0,
+              blocked     INTEGER NOT NULL DEFAULT 0,
+              status      TEXT NOT NULL DEFAULT 'running',  -- running / done
+              created_at  TEXT DEFAULT (datetime('now')),
+              finished_at TEXT
+            );
+
+            /* Общее для всех инстансов рабочее состояние: версия правил, интервалы опроса */
+            CREATE TABLE IF NOT EXISTS runtime_state(
+              key         TEXT PRIMARY KEY,
+              value       REAL NOT NULL
+            );
+
+            /* Дропы, по которым идут покупки: если лидер упал посреди дропа,
+               новый лидер докупает их (main.start_watcher -> autobuy.resume_drops) */
+            CREATE TABLE IF NOT EXISTS drops(
+              gift_id     TEXT PRIMARY KEY,
+              title       TEXT,
+              price       INTEGER NOT NULL,
+              limited     INTEGER NOT NULL DEFAULT 0,
+              supply      INTEGER,
+              total       INTEGER,
+              fence       INTEGER,                      -- токен лиза лидера, который покупает
+              started_at  REAL NOT NULL                 -- unix time
+            );
+
+            /* Лизы для выбора лидера между инстансами (см. leader.py) */
+            CREATE TABLE IF NOT EXISTS leases(
+              name        TEXT PRIMARY KEY,
+              holder      TEXT NOT NULL,
+              token       INTEGER NOT NULL,             -- fencing token, растёт при смене владельца
+              expires_at  REAL NOT NULL                 -- unix time
+            );
+
             CREATE TABLE IF NOT EXISTS logs(
               id          INTEGER PRIMARY KEY AUTOINCREMENT,
               level       TEXT NOT NULL,
@@ -63,8 +171,46 @@ async def init_db(database_url: str) -> None:
             );
             """
         )
+        # миграции старых баз: новые колонки кэша каталога
+        await _ensure_column(db, "gifts_cache", "supply", "INTEGER")
+        await _ensure_column(db, "gifts_cache", "active", "INTEGER NOT NULL DEFAULT 1")
+        await _ensure_column(db, "rules", "copies", "INTEGER NOT NULL DEFAULT 1")
+        await _ensure_column(db, "purchases", "fence", "INTEGER")
+        await _ensure_column(db, "users", "subscribed", "INTEGER NOT NULL DEFAULT 0")
+        await _ensure_column(db, "users", "blocked", "INTEGER NOT NULL DEFAULT 0")
+        await db.execute(
+            "CREATE INDEX IF NOT EXISTS idx_users_subscribed ON users(subscribed, blocked, user_id)"
+        )
         await db.commit()
 
+async def _ensure_column(db, table: str, column: str, decl: str) -> None:
+    cur = await db.execute(f"PRAGMA table_info({table})")
+    if column not in {r[1] for r in await cur.fetchall()}:
+        try:
+            await db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+        except aiosqlite.OperationalError as e:
+            # соседний инстанс успел мигрировать раньше нас
+            if "duplicate column" not in str(e):
+                raise
+
+# Версия правил хранится в общей БД (runtime_state): меняется при любой правке
+# правил/автобая в той же транзакции, по ней rules_engine понимает, что
+# скомпилированные массивы устарели — в том числе если правку принял другой инстанс
+RULES_VERSION_KEY = "rules_version"
+
+async def rules_version() -> int:
+    async with _conn() as db:
+        cur = await db.execute("SELECT value FROM runtime_state WHERE key=?", (RULES_VERSION_KEY,))
+        row = await cur.fetchone()
+        return int(row["value"]) if row else 0
+
+async def _bump_rules_version(db) -> None:
+    await db.execute(
+        "INSERT INTO runtime_state(key, value) VALUES(?, 1) "
+        "ON CONFLICT(key) DO UPDATE SET value=value+1",
+        (RULES_VERSION_KEY,),
+    )
+
 @asynccontextmanager
 async def _conn():
     if _SQLITE_PATH is None:
@@ -103,9 +249,72 @@ async def add_balance(user_id: int, amount: int) -> None:
         )
         await db.commit()
 
+async def reserve_balance(user_id: int, gift_id: str, price: int, copies: int) -> tuple[int, int]:
+    """
+    Атомарно списывает звёзды под покупку: сколько копий из copies по цене price
+    влезает в баланс, столько и резервирует. Возвращает (id резерва, копий);
+    резерв закрывает release_reservation, копии отмечает record_purchase.
+    Если процесс работает под лизом (set_fence), а лиз уже у другого — (0, 0).
+    """
+    async with _conn() as db:
+        await db.execute("BEGIN IMMEDIATE")
+        if not await _fence_ok(db):
+            await db.rollback()
+            return 0, 0
+        if price <= 0:
+            n = copies
+        else:
+            cur = await db.execute("SELECT balance FROM users WHERE user_id=?", (user_id,))
+            row = await cur.fetchone()
+            n = max(0, min(copies, int(row["balance"]) // price)) if row else 0
+        rid = 0
+        if n > 0:
+            await db.execute("UPDATE users SET balance = balance - ? WHERE user_id=?", (n * price, user_id))
+            cur = await db.execute(
+                "INSERT INTO reservations(user_id, gift_id, price, copies, fence) VALUES(?,?,?,?,?)",
+                (user_id, str(gift_id), int(price), n, _FENCE[1] if _FENCE else None),
+            )
+            rid = cur.lastrowid
+        await db.commit()
+        return rid, n
+
+async def release_reservation(reservation_id: int) -> int:
+    """Закрывает резерв и возвращает звёзды за неотправленные копии. Возвращает сумму возврата."""
+    async with _conn() as db:
+        await db.execute("BEGIN IMMEDIATE")
+        refund = await _close_reservations(db, "id=?", (reservation_id,))
+        await db.commit()
+        return refund
+
+async def refund_open_reservations() -> int:
+    """
+    Возвращает звёзды по всем открытым резервам — их владелец упал посреди
+    покупок. Вызывается перед стартом watcher'а (при запуске и при перехвате
+    лидерства), пока у этого процесса своих резервов нет. Возвращает сумму.
+    """
+    async with _conn() as db:
+        await db.execute("BEGIN IMMEDIATE")
+        refund = await _close_reservations(db, "state='open'", ())
+        await db.commit()
+        return refund
+
+async def _close_reservations(db, where: str, params: tuple) -> int:
+    cur = await db.execute(
+        f"SELECT id, user_id, price * (copies - sent) AS refund FROM reservations WHERE state='open' AND {where}",
+        params,
+    )
+    rows = await cur.fetchall()
+    await db.executemany(
+        "UPDATE users SET balance = balance + ? WHERE user_id=?",
+        [(int(r["refund"]), r["user_id"]) for r in rows if r["refund"] > 0],
+    )
+    await db.executemany("UPDATE reservations SET state='closed' WHERE id=?", [(r["id"],) for r in rows])
+    return sum(max(0, int(r["refund"])) for r in rows)
+
 async def set_autobuy(user_id: int, enabled: bool) -> None:
     async with _conn() as db:
         await db.execute("UPDATE users SET autobuy=? WHERE user_id=?", (1 if enabled else 0, user_id))
+        await _bump_rules_version(db)
         await db.commit()
 
 async def is_autobuy(user_id: int) -> bool:
@@ -132,7 +341,7 @@ async def autobuy_users_with_rules() -> Sequence[aiosqlite.Row]:
 async def get_rules(user_id: int) -> dict:
     async with _conn() as db:
         cur = await db.execute(
-            "SELECT only_limited, min_price, max_price FROM rules WHERE user_id=?",
+            "SELECT only_limited, min_price, max_price, copies FROM rules WHERE user_id=?",
             (user_id,)
         )
         row = await cur.fetchone()
@@ -140,11 +349,12 @@ async def get_rules(user_id: int) -> dict:
             # создаём дефолт если нет
             await db.execute("INSERT OR IGNORE INTO rules(user_id) VALUES(?)", (user_id,))
             await db.commit()
-            return {"only_limited": 1, "min_price": 0, "max_price": 1000000000}
+            return {"only_limited": 1, "min_price": 0, "max_price": 1000000000, "copies": 1}
         return {
             "only_limited": int(row["only_limited"]),
             "min_price": int(row["min_price"]),
             "max_price": int(row["max_price"]),
+            "copies": int(row["copies"]),
         }
 
 async def set_only_limited(user_id: int, enabled: bool) -> None:
@@ -153,6 +363,7 @@ async def set_only_limited(user_id: int, enabled: bool) -> None:
             "UPDATE rules SET only_limited=?, updated_at=datetime('now') WHERE user_id=?",
             (1 if enabled else 0, user_id)
         )
+        await _bump_rules_version(db)
         await db.commit()
 
 async def set_price_range(user_id: int, min_price: int, max_price: int) -> None:
@@ -167,17 +378,490 @@ async def set_price_range(user_id: int, min_price: int, max_price: int) -> None:
             "UPDATE rules SET min_price=?, max_price=?, updated_at=datetime('now') WHERE user_id=?",
             (int(min_price), int(max_price), user_id)
         )
+        await _bump_rules_version(db)
+        await db.commit()
+
+MAX_COPIES = 100
+
+async def set_copies(user_id: int, copies: int) -> None:
+    copies = min(MAX_COPIES, max(1, int(copies)))
+    async with _conn() as db:
+        await db.execute(
+            "UPDATE rules SET copies=?, updated_at=datetime('now') WHERE user_id=?",
+            (copies, user_id)
+        )
+        await _bump_rules_version(db)
+        await db.commit()
+
+# ---------- Extended rules ----------
+RULE_FIELDS = ("min_price", "max_price", "gift_id", "max_copies", "only_limited", "daily_budget", "drop_budget")
+
+async def add_rule(user_id: int, **fields) -> int:
+    if fields.get("max_copies") is not None:
+        # тот же потолок, что и у /copies — одно правило не должно заказывать бесконечный burst
+        fields["max_copies"] = min(MAX_COPIES, max(1, int(fields["max_copies"])))
+    cols = [k for k in RULE_FIELDS if k in fields]
+    async with _conn() as db:
+        cur = await db.execute(
+            f"INSERT INTO user_rules(user_id{''.join(', ' + c for c in cols)}) "
+            f"VALUES(?{', ?' * len(cols)})",
+            (user_id, *(fields[c] for c in cols)),
+        )
+        await _bump_rules_version(db)
+        await db.commit()
+        return int(cur.lastrowid)
+
+async def delete_rule(user_id: int, rule_id: int) -> bool:
+    async with _conn() as db:
+        cur = await db.execute("DELETE FROM user_rules WHERE id=? AND user_id=?", (rule_id, user_id))
+        await _bump_rules_version(db)
+        await db.commit()
+        return cur.rowcount > 0
+
+async def list_rules(user_id: int) -> Sequence[aiosqlite.Row]:
+    async with _conn() as db:
+        cur = await db.execute(
+            f"SELECT id, {', '.join(RULE_FIELDS)} FROM user_rules WHERE user_id=? ORDER BY id",
+            (user_id,),
+        )
+        return await cur.fetchall()
+
+async def autobuy_rules() -> Sequence[aiosqlite.Row]:
+    """
+    Все действующие правила пользователей с включённым автобаем.
+    Базовое правило (rules) участвует, только если расширенных нет.
+    """
+    async with _conn() as db:
+        cur = await db.execute(
+            """
+            SELECT ur.id, ur.user_id, ur.min_price, ur.max_price, ur.gift_id, ur.max_copies,
+                   ur.only_limited, ur.daily_budget, ur.drop_budget
+            FROM user_rules ur
+            JOIN users u ON u.user_id = ur.user_id
+            WHERE u.autobuy = 1
+            UNION ALL
+            SELECT 0, r.user_id, r.min_price, r.max_price, NULL, r.copies,
+                   r.only_limited, NULL, NULL
+            FROM rules r
+            JOIN users u ON u.user_id = r.user_id
+            WHERE u.autobuy = 1
+              AND NOT EXISTS (SELECT 1 FROM user_rules ur WHERE ur.user_id = r.user_id)
+            """
+        )
+        return await cur.fetchall()
+
+async def record_purchase(user_id: int, gift_id: str, price: int, reservation_id: int = 0) -> None:
+    # подарок уже отправлен — пишем всегда, fence только для аудита;
+    # копия засчитывается в резерв в той же транзакции, возврат её уже не вернёт
+    async with _conn() as db:
+        await db.execute(
+            "INSERT INTO purchases(user_id, gift_id, price, fence, ts) VALUES(?,?,?,?,datetime(?, 'unixepoch'))",
+            (user_id, str(gift_id), int(price), _FENCE[1] if _FENCE else None, _CLOCK()),
+        )
+        if reservation_id:
+            await db.execute(
+                "UPDATE reservations SET sent = sent + 1 WHERE id=? AND state='open'", (reservation_id,)
+            )
+        await db.commit()
+
+async def purchased_copies(gift_ids: Sequence[str]) -> dict[tuple[int, str], int]:
+    """Сколько копий каждого из подарков уже отправлено: {(user_id, gift_id): n}."""
+    if not gift_ids:
+        return {}
+    async with _conn() as db:
+        cur = await db.execute(
+            f"""
+            SELECT user_id, gift_id, COUNT(*) AS n FROM purchases
+            WHERE gift_id IN ({','.join('?' * len(gift_ids))})
+            GROUP BY user_id, gift_id
+            """,
+            [str(g) for g in gift_ids],
+        )
+        return {(int(r["user_id"]), r["gift_id"]): int(r["n"]) for r in await cur.fetchall()}
+
+async def spent_today(now: float | None = None) -> dict[int, int]:
+    """
+    Сколько ⭐ автобай потратил за текущие сутки (UTC), по пользователям.
+    now — unix-время «сейчас»; по умолчанию берётся из часов set_clock.
+    """
+    async with _conn() as db:
+        cur = await db.execute(
+            """
+            SELECT user_id, SUM(price) AS spent FROM purchases
+            WHERE ts >= datetime(?, 'unixepoch', 'start of day')
+            GROUP BY user_id
+            """,
+            (_CLOCK() if now is None else now,),
+        )
+        return {int(r["user_id"]): int(r["spent"]) for r in await cur.fetchall()}
+
+# ---------- Subscriptions / broadcasts ----------
+async def set_subscribed(user_id: int, enabled: bool) -> None:
+    async with _conn() as db:
+        # подписка = пользователь снова пишет боту, значит не заблокировал
+        await db.execute(
+            "UPDATE users SET subscribed=?, blocked=0 WHERE user_id=?",
+            (1 if enabled else 0, user_id),
+        )
         await db.commit()
 
+async def is_subscribed(user_id: int) -> bool:
+    async with _conn() as db:
+        cur = await db.execute("SELECT subscribed FROM users WHERE user_id=?", (user_id,))
+        row = await cur.fetchone()
+        return bool(row and row["subscribed"])
+
+async def count_subscribers() -> int:
+    async with _conn() as db:
+        cur = await db.execute("SELECT COUNT(*) AS n FROM users WHERE subscribed=1 AND blocked=0")
+        return int((await cur.fetchone())["n"])
+
+async def subscribers_page(after_user_id: int, limit: int) -> list[int]:
+    """Keyset-страница подписчиков по возрастанию user_id."""
+    async with _conn() as db:
+        cur = await db.execute(
+            """
+            SELECT user_id FROM users
+            WHERE subscribed=1 AND blocked=0 AND user_id>?
+            ORDER BY user_id LIMIT ?
+            """,
+            (int(after_user_id), int(limit)),
+        )
+        return [int(r["user_id"]) for r in await cur.fetchall()]
+
+async def mark_blocked(user_ids: Iterable[int]) -> None:
+    async with _conn() as db:
+        await db.executemany("UPDATE users SET blocked=1 WHERE user_id=?", [(u,) for u in user_ids])
+        await db.commit()
+
+async def create_broadcast(text: str) -> int:
+    total = await count_subscribers()
+    async with _conn() as db:
+        cur = await db.execute("INSERT INTO broadcasts(text, total) VALUES(?, ?)", (text, total))
+        await db.commit()
+        return int(cur.lastrowid)
+
+async def next_broadcast() -> aiosqlite.Row | None:
+    async with _conn() as db:
+        cur = await db.execute(
+            "SELECT * FROM broadcasts WHERE status='running' ORDER BY id LIMIT 1"
+        )
+        return await cur.fetchone()
+
+async def save_broadcast_progress(bid: int, cursor: int, sent: int, failed: int, blocked: int) -> None:
+    """Сдвигает курсор и прибавляет счётчики (дельты с прошлого сохранения)."""
+    async with _conn() as db:
+        await db.execute(
+            """
+            UPDATE broadcasts SET cursor=?, sent=sent+?, failed=failed+?, blocked=blocked+?
+            WHERE id=?
+            """,
+            (int(cursor), sent, failed, blocked, bid),
+        )
+        await db.commit()
+
+async def finish_broadcast(bid: int) -> None:
+    async with _conn() as db:
+        await db.execute(
+            "UPDATE broadcasts SET status='done', finished_at=datetime('now') WHERE id=?", (bid,)
+        )
+        await db.commit()
+
+async def recent_broadcasts(limit: int = 5) -> Sequence[aiosqlite.Row]:
+    async with _conn() as db:
+        cur = await db.execute("SELECT * FROM broadcasts ORDER BY id DESC LIMIT ?", (limit,))
+        return await cur.fetchall()
+
+# ---------- Leases (leader election) ----------
+# (имя лиза, токен) — под каким лизом этот процесс делает покупки; None = без HA
+_FENCE: tuple[str, int] | None = None
+
+async def get_runtime(*keys: str) -> dict[str, float]:
+    async with _conn() as db:
+        cur = await db.execute(
+            f"SELECT key, value FROM runtime_state WHERE key IN ({','.join('?' * len(keys))})", keys
+        )
+        return {r["key"]: float(r["value"]) for r in await cur.fetchall()}
+
+async def set_runtime(**values: float) -> None:
+    async with _conn() as db:
+        await db.executemany(
+            "INSERT INTO runtime_state(key, value) VALUES(?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET value=excluded.value",
+            [(k, float(v)) for k, v in values.items()],
+        )
+        await db.commit()
+
+def set_fence(name: str | None, token: int | None = None) -> None:
+    global _FENCE
+    _FENCE = (name, int(token)) if name is not None and token is not None else None
+
+async def _fence_ok(db) -> bool:
+    if _FENCE is None:
+        return True
+    cur = await db.execute("SELECT token FROM leases WHERE name=?", (_FENCE[0],))
+    row = await cur.fetchone()
+    return bool(row) and int(row["token"]) == _FENCE[1]
+
+async def acquire_lease(name: str, holder: str, ttl: float) -> int | None:
+    """
+    Берёт или продлевает лиз. Токен растёт только при смене владельца.
+    Возвращает токен, если лиз наш, иначе None.
+    """
+    now = time.time()
+    async with _conn() as db:
+        # standby опрашивает часто: чужой живой лиз видно без writer-лока
+        cur = await db.execute("SELECT holder, expires_at FROM leases WHERE name=?", (name,))
+        row = await cur.fetchone()
+        if row is not None and row["holder"] != holder and row["expires_at"] > now:
+            return None
+        await db.execute("BEGIN IMMEDIATE")
+        cur = await db.execute("SELECT holder, token, expires_at FROM leases WHERE name=?", (name,))
+        row = await cur.fetchone()
+        if row is None:
+            token = 1
+            await db.execute(
+                "INSERT INTO leases(name, holder, token, expires_at) VALUES(?,?,?,?)",
+                (name, holder, token, now + ttl),
+            )
+        elif row["holder"] == holder and row["expires_at"] > now:
+            token = int(row["token"])
+            await db.execute("UPDATE leases SET expires_at=? WHERE name=?", (now + ttl, name))
+        elif row["expires_at"] <= now:
+            token = int(row["token"]) + 1
+            await db.execute(
+                "UPDATE leases SET holder=?, token=?, expires_at=? WHERE name=?",
+                (holder, token, now + ttl, name),
+            )
+        else:
+            await db.rollback()
+            return None
+        await db.commit()
+        return token
+
+def lease_connection(timeout: float) -> sqlite3.Connection:
+    """Отдельное синхронное соединение для потока, продлевающего лиз (leader._Renewer)."""
+    if _SQLITE_PATH is None:
+        raise RuntimeError("DB not initialized. Call init_db() first.")
+    return sqlite3.connect(_SQLITE_PATH, timeout=timeout, isolation_level=None)
+
+def renew_lease_sync(conn: sqlite3.Connection, name: str, holder: str, token: int, ttl: float) -> bool:
+    """Продлевает свой лиз; False — лиз уже перехвачен (токен сменился)."""
+    cur = conn.execute(
+        "UPDATE leases SET expires_at=? WHERE name=? AND holder=? AND token=?",
+        (time.time() + ttl, name, holder, token),
+    )
+    return cur.rowcount == 1
+
+async def release_lease(name: str, holder: str) -> None:
+    async with _conn() as db:
+        await db.execute("UPDATE leases SET expires_at=0 WHERE name=? AND holder=?", (name, holder))
+        await db.commit()
+
+async def lease_info(name: str) -> aiosqlite.Row | None:
+    async with _conn() as db:
+        cur = await db.execute("SELECT holder, token, expires_at FROM leases WHERE name=?", (name,))
+        return await cur.fetchone()
+
+# ---------- In-flight drops ----------
+async def start_drops(gifts: Sequence[dict]) -> None:
+    async with _conn() as db:
+        await db.executemany(
+            "INSERT OR REPLACE INTO drops(gift_id, title, price, limited, supply, total, fence, started_at) "
+            "VALUES(?,?,?,?,?,?,?,?)",
+            [
+                (str(g["id"]), g.get("title") or "", int(g.get("price") or 0), 1 if g.get("limited") else 0,
+                 g.get("supply"), g.get("total"), _FENCE[1] if _FENCE else None, time.time())
+                for g in gifts
+            ],
+        )
+        await db.commit()
+
+async def finish_drops(gift_ids: Sequence[str]) -> None:
+    """
+    Снимает отметку «идут покупки». Если лиз уже у другого, отметки остаются:
+    покупки этого процесса оборвал fencing, дроп докупит новый лидер.
+    """
+    async with _conn() as db:
+        await db.execute("BEGIN IMMEDIATE")
+        if not await _fence_ok(db):
+            await db.rollback()
+            return
+        await db.executemany("DELETE FROM drops WHERE gift_id=?", [(str(g),) for g in gift_ids])
+        await db.commit()
+
+async def unfinished_drops(max_age: float) -> list[dict]:
+    """Дропы, брошенные упавшим процессом; старше max_age сек — удаляются без докупки."""
+    async with _conn() as db:
+        await db.execute("DELETE FROM drops WHERE started_at < ?", (time.time() - max_age,))
+        await db.commit()
+        cur = await db.execute("SELECT * FROM drops ORDER BY started_at")
+        return [
+            {"id": r["gift_id"], "title": r["title"], "price": int(r["price"]), "limited": bool(r["limited"]),
+             "supply": r["supply"], "total": r["total"]}
+            for r in await cur.fetchall()
+        ]
+
 # ---------- Gifts cache / logs ----------
-async def upsert_gifts_cache(items: Iterable[dict]) -> None:
+async def upsert_gifts_cache(items: Iterable[dict]) -> list[tuple]:
+    """
+    Кладёт в кэш подарки, найденные неполным источником (sources.EndpointSource),
+    и пишет в catalog_journal их появление (J_ADDED) — полный опрос потом видит
+    их уже в кэше и журналит только изменения. Возвращает записанные события.
+    """
+    items = list(items)
+    if not items:
+        return []
+    ts = int(time.time() * 1000)
     async with _conn() as db:
+        await db.execute("BEGIN IMMEDIATE")
+        ids = [str(it["id"]) for it in items]
+        cur = await db.execute(
+            f"SELECT gift_id FROM gifts_cache WHERE active=1 AND gift_id IN ({','.join('?' * len(ids))})", ids
+        )
+        active = {r["gift_id"] for r in await cur.fetchall()}
+        events = [
+            (str(it["id"]), ts, J_ADDED, int(it.get("price", 0)), it.get("supply"))
+            for it in items if str(it["id"]) not in active
+        ]
+        if events:
+            await db.executemany(
+                "INSERT OR IGNORE INTO catalog_journal(gift_id, ts, kind, price, supply) VALUES(?,?,?,?,?)",
+                events,
+            )
+        await db.executemany(
+            """
+            INSERT INTO gifts_cache(gift_id, title, price, supply, active) VALUES(?,?,?,?,1)
+            ON CONFLICT(gift_id) DO UPDATE SET
+              title=excluded.title, price=excluded.price, supply=excluded.supply, active=1
+            """,
+            [(str(it["id"]), it.get("title", ""), int(it.get("price", 0)), it.get("supply")) for it in items],
+        )
+        await db.commit()
+        return events
+
+# Типы событий журнала каталога
+J_ADDED = 1
+J_REMOVED = 2
+J_PRICE = 3
+J_SUPPLY = 4
+
+async def apply_catalog_snapshot(items: Sequence[dict]) -> tuple[set[str], list[tuple]]:
+    """
+    Сравнивает свежий каталог с кэшем, пишет дельты в catalog_journal и
+    обновляет кэш одной транзакцией.
+    Возвращает (id впервые увиденных подарков, события (gift_id, ts, kind, price, supply)).
+    """
+    ts = int(time.time() * 1000)
+    async with _conn() as db:
+        cur = await db.execute("SELECT gift_id, price, supply, active FROM gifts_cache")
+        prev = {r["gift_id"]: r for r in await cur.fetchall()}
+
+        new_ids: set[str] = set()
+        events: list[tuple] = []
+        seen: set[str] = set()
         for it in items:
-            await db.execute(
-                "INSERT OR REPLACE INTO gifts_cache(gift_id, title, price) VALUES(?,?,?)",
-                (str(it["id"]), it.get("title", ""), int(it.get("price", 0))),
+            gid = str(it["id"])
+            price = int(it.get("price", 0))
+            supply = it.get("supply")
+            seen.add(gid)
+            old = prev.get(gid)
+            if old is None:
+                new_ids.add(gid)
+                events.append((gid, ts, J_ADDED, price, supply))
+                continue
+            if not old["active"]:
+                events.append((gid, ts, J_ADDED, price, supply))
+                continue
+            if old["price"] != price:
+                events.append((gid, ts, J_PRICE, price, supply))
+            if supply is not None and old["supply"] != supply:
+                events.append((gid, ts, J_SUPPLY, price, supply))
+
+        for gid, old in prev.items():
+            if old["active"] and gid not in seen:
+                events.append((gid, ts, J_REMOVED, old["price"], old["supply"]))
+
+        if events:
+            await db.executemany(
+                "INSERT OR IGNORE INTO catalog_journal(gift_id, ts, kind, price, supply) VALUES(?,?,?,?,?)",
+                events,
             )
+        await db.executemany(
+            """
+            INSERT INTO gifts_cache(gift_id, title, price, supply, active) VALUES(?,?,?,?,1)
+            ON CONFLICT(gift_id) DO UPDATE SET
+              title=excluded.title, price=excluded.price, supply=excluded.supply, active=1
+            """,
+            [(str(it["id"]), it.get("title", ""), int(it.get("price", 0)), it.get("supply")) for it in items],
+        )
+        gone = [(gid,) for gid, old in prev.items() if old["active"] and gid not in seen]
+        if gone:
+            await db.executemany("UPDATE gifts_cache SET active=0 WHERE gift_id=?", gone)
         await db.commit()
+        return new_ids, events
+
+async def supply_series(gift_id: str, since_ms: int = 0) -> list[tuple[int, int]]:
+    """Временной ряд остатка подарка: [(ts_ms, supply), ...] по возрастанию ts."""
+    async with _conn() as db:
+        cur = await db.execute(
+            """
+            SELECT ts, supply FROM catalog_journal
+            WHERE gift_id=? AND ts>=? AND supply IS NOT NULL
+            ORDER BY ts
+            """,
+            (str(gift_id), int(since_ms)),
+        )
+        return [(int(r["ts"]), int(r["supply"])) for r in await cur.fetchall()]
+
+async def supply_series_since(since_ms: int) -> dict[str, list[tuple[int, int]]]:
+    """Ряды остатка за окно одним запросом — только по подаркам, у которых остаток менялся."""
+    async with _conn() as db:
+        cur = await db.execute(
+            """
+            SELECT gift_id, ts, supply FROM catalog_journal
+            WHERE ts>=? AND supply IS NOT NULL
+              AND gift_id IN (SELECT gift_id FROM catalog_journal WHERE ts>=? AND kind=?)
+            ORDER BY gift_id, ts
+            """,
+            (int(since_ms), int(since_ms), J_SUPPLY),
+        )
+        out: dict[str, list[tuple[int, int]]] = {}
+        for r in await cur.fetchall():
+            out.setdefault(r["gift_id"], []).append((int(r["ts"]), int(r["supply"])))
+        return out
+
+JOURNAL_PRUNE_BATCH = 5000
+
+async def prune_catalog_journal(before_ms: int) -> int:
+    """Удаляет записи журнала старше before_ms пачками, чтобы не держать writer-лок надолго."""
+    deleted = 0
+    while True:
+        async with _conn() as db:
+            cur = await db.execute(
+                """
+                DELETE FROM catalog_journal WHERE (gift_id, ts, kind) IN (
+                  SELECT gift_id, ts, kind FROM catalog_journal WHERE ts<? LIMIT ?
+                )
+                """,
+                (int(before_ms), JOURNAL_PRUNE_BATCH),
+            )
+            await db.commit()
+            n = cur.rowcount or 0
+        deleted += n
+        if n < JOURNAL_PRUNE_BATCH:
+            return deleted
+
+async def journal_events(gift_id: str, limit: int = 20) -> Sequence[aiosqlite.Row]:
+    async with _conn() as db:
+        cur = await db.execute(
+            """
+            SELECT ts, kind, price, supply FROM catalog_journal
+            WHERE gift_id=? ORDER BY ts DESC LIMIT ?
+            """,
+            (str(gift_id), int(limit)),
+        )
+        return await cur.fetchall()
 
 async def known_gift_ids() -> set[str]:
     async with _conn() as db:
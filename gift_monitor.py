@@ -0,0 +1,68 @@
+"""
+Опрос стороннего эндпоинта каталога подарков с ETag (If-None-Match).
+
+Отдельный модуль без побочных эффектов при импорте: им пользуются и
+usergift_buy.py (скрипт юзер-аккаунтов), и sources.EndpointSource внутри бота.
+"""
+import logging
+from typing import Any, Dict, List, Optional
+
+import aiohttp
+
+logger = logging.getLogger("giftbot.gift_monitor")
+
+
+class GiftMonitor:
+    def __init__(self, session: aiohttp.ClientSession, url: str):
+        self.session = session
+        self.url = url
+        self.etag = None
+
+    async def fetch(self) -> Optional[Dict[str, Any]]:
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        try:
+            async with self.session.get(self.url, headers=headers, timeout=5) as r:
+                if r.status == 304:
+                    return None
+                if et := r.headers.get("ETag"):
+                    self.etag = et
+                if r.status == 401:
+                    # Не фатально для мониторинга
+                    data = await r.text()
+                    logger.debug("Unauthorized on gifts endpoint: %s", data)
+                    return {}
+                r.raise_for_status()
+                return await r.json()
+        except Exception as e:
+            logger.warning("fetch gifts error: %s", e)
+            return {}
+
+    @staticmethod
+    def parse_limited(items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        out = []
+        for it in items:
+            # Безопасный парсинг
+            gift_id = it.get("id") or it.get("gift_id") or it.get("slug")
+            total = it.get("total_count")
+            remain = it.get("remaining_count")
+            is_limited = it.get("is_limited")
+            price = it.get("price_stars") or it.get("price")  # в звёздах
+
+            limited_flag = False
+            if is_limited is True:
+                limited_flag = True
+            elif total is not None:
+                limited_flag = True
+            elif remain is not None:
+                limited_flag = True
+
+            out.append({
+                "gift_id": gift_id,
+                "price": price,
+                "total_count": total,
+                "remaining_count": remain,
+                "is_limited": limited_flag
+            })
+        return out
@@ -0,0 +1,56 @@
+import time
+from dataclasses import dataclass
+from typing import Optional, Sequence
+
+import db
+
+# ========= СКОРОСТЬ РАСПРОДАЖИ (sell-through) =========
+@dataclass(frozen=True)
+class SellThrough:
+    gift_id: str
+    first_supply: int
+    last_supply: int
+    sold: int
+    span_sec: float
+    per_min: float                 # штук в минуту
+    eta_sec: Optional[float]       # до нуля при текущем темпе, None если темп 0
+
+
+def sell_through(gift_id: str, series: Sequence[tuple[int, int]]) -> Optional[SellThrough]:
+    """Считает темп по ряду [(ts_ms, supply)]. Нужно минимум две точки."""
+    if len(series) < 2:
+        return None
+    (t0, s0), (t1, s1) = series[0], series[-1]
+    span = max(0.001, (t1 - t0) / 1000.0)
+    # остаток может и подрасти (допечатка) — считаем только убыль
+    sold = sum(max(0, a[1] - b[1]) for a, b in zip(series, series[1:]))
+    per_min = sold / span * 60.0
+    eta = (s1 / per_min * 60.0) if per_min > 0 else None
+    return SellThrough(gift_id, s0, s1, sold, span, per_min, eta)
+
+
+async def velocity(gift_id: str, window_sec: int = 3600) -> Optional[SellThrough]:
+    since = int((time.time() - window_sec) * 1000)
+    return sell_through(str(gift_id), await db.supply_series(gift_id, since))
+
+
+async def top_velocity(window_sec: int = 3600, limit: int = 10) -> list[SellThrough]:
+    """Самые быстро распродаваемые подарки за окно."""
+    since = int((time.time() - window_sec) * 1000)
+    out = []
+    for gid, series in (await db.supply_series_since(since)).items():
+        st = sell_through(gid, series)
+        if st is not None:
+            out.append(st)
+    out.sort(key=lambda s: s.per_min, reverse=True)
+    return out[:limit]
+
+
+def format_eta(sec: Optional[float]) -> str:
+    if sec is None:
+        return "∞"
+    if sec < 120:
+        return f"{sec:.0f} сек"
+    if sec < 7200:
+        return f"{sec / 60:.0f} мин"
+    return f"{sec / 3600:.1f} ч"
@@ -0,0 +1,269 @@
+"""
+Выбор лидера между инстансами бота через лиз в общей SQLite.
+
+Лидер продлевает лиз каждые RENEW_EVERY сек; если он умер, лиз истекает через
+LEASE_TTL, и первый standby, который его заберёт, становится лидером с новым
+fencing-токеном. Токен выставляется в db.set_fence(): db.reserve_balance
+проверяет его в той же транзакции, так что «воскресший» старый лидер
+больше ничего не купит.
+
+Перехват укладывается в секунду: LEASE_TTL + STANDBY_POLL ≈ 0.9 сек. Чтобы
+короткий TTL не передавал лидерство при каждом подвисании event loop'а,
+продлевает лиз отдельный поток со своим sqlite3-соединением (_Renewer), а не
+корутина. Зависший loop продлению не мешает; помешать может только
+writer-лок SQLite, который держат дольше TTL, — транзакции бота короткие.
+
+Standby держат прогретыми HTTP-сессию и скомпилированные правила, чтобы
+после перехвата первый опрос шёл сразу.
+
+Проверка на нескольких локальных процессах:
+
+    python leader.py --instances 3 --db /tmp/ha.db --kill-after 3 [--ttl 0.8 --renew 0.2]
+"""
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Awaitable, Callable, Optional
+
+import db
+
+logger = logging.getLogger("giftbot.leader")
+
+LEASE_NAME = "watcher"
+LEASE_TTL = 0.8          # сек; за это время standby замечает смерть лидера
+RENEW_EVERY = 0.2        # лидер продлевает лиз (из потока _Renewer)
+STANDBY_POLL = 0.1       # standby пытается взять лиз
+ELECT_RETRY = 1.0        # пауза после неудачного on_elected
+WARM_EVERY = 5.0         # прогрев кэшей на standby
+
+
+def make_holder_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+
+class _Renewer(threading.Thread):
+    """
+    Продлевает лиз лидера каждые every сек вне event loop'а. Если лиз
+    перехвачен или не продлевался дольше ttl (БД недоступна), зовёт on_lost
+    и завершается.
+    """
+
+    def __init__(self, name: str, holder: str, token: int, ttl: float, every: float, on_lost: Callable[[], None]):
+        super().__init__(name=f"lease-renew-{token}", daemon=True)
+        self.lease = name
+        self.holder = holder
+        self.token = token
+        self.ttl = ttl
+        self.every = every
+        self.on_lost = on_lost
+        self._halt = threading.Event()
+
+    def run(self) -> None:
+        deadline = time.time() + self.ttl
+        conn = db.lease_connection(timeout=self.every)
+        try:
+            while not self._halt.wait(self.every):
+                try:
+                    ok = db.renew_lease_sync(conn, self.lease, self.holder, self.token, self.ttl)
+                except sqlite3.Error as e:
+                    logger.warning("lease renew failed: %s", e)
+                    ok = None
+                if ok:
+                    deadline = time.time() + self.ttl
+                elif ok is False or time.time() >= deadline:
+                    if not self._halt.is_set():
+                        self.on_lost()
+                    return
+        finally:
+            conn.close()
+
+    def stop(self) -> None:
+        self._halt.set()
+
+
+class LeaderElector:
+    def __init__(
+        self,
+        on_elected: Callable[[int], Awaitable[None]],
+        on_demoted: Callable[[], Awaitable[None]],
+        warm: Optional[Callable[[], Awaitable[None]]] = None,
+        holder: Optional[str] = None,
+        name: str = LEASE_NAME,
+        ttl: float = LEASE_TTL,
+        renew_every: float = RENEW_EVERY,
+        standby_poll: float = STANDBY_POLL,
+    ):
+        if renew_every * 2 >= ttl:
+            raise ValueError("lease renew interval must be well below the TTL")
+        self.on_elected = on_elected
+        self.on_demoted = on_demoted
+        self.warm = warm
+        self.holder = holder or make_holder_id()
+        self.name = name
+        self.ttl = ttl
+        self.renew_every = renew_every
+        self.standby_poll = standby_poll
+        self.token: Optional[int] = None
+        self.elected_at: Optional[float] = None
+        self._task: Optional[asyncio.Task] = None
+        self._renewer: Optional[_Renewer] = None
+        self._lost = asyncio.Event()
+
+    @property
+    def is_leader(self) -> bool:
+        return self.token is not None
+
+    def _lease_lost(self) -> None:
+        # из потока _Renewer
+        try:
+            self._loop.call_soon_threadsafe(self._lost.set)
+        except RuntimeError:
+            pass    # loop уже закрыт
+
+    async def _become_leader(self, token: int) -> bool:
+        self.token = token
+        self.elected_at = time.monotonic()
+        db.set_fence(self.name, token)
+        self._lost.clear()
+        self._renewer = _Renewer(self.name, self.holder, token, self.ttl, self.renew_every, self._lease_lost)
+        self._renewer.start()
+        logger.info("%s: elected leader (token %d)", self.holder, token)
+        try:
+            await self.on_elected(token)
+            return True
+        except Exception as e:
+            # не смогли поднять watcher — лидером не считаемся, лиз отдаём другим
+            logger.error("%s: on_elected failed, giving up leadership: %s", self.holder, e)
+            await self._step_down()
+            try:
+                await db.release_lease(self.name, self.holder)
+            except Exception as e2:
+                logger.warning("lease release failed: %s", e2)
+            return False
+
+    async def _step_down(self) -> None:
+        logger.warning("%s: lost leadership (token %s)", self.holder, self.token)
+        if self._renewer is not None:
+            # дожидаемся потока: продление после release_lease вернуло бы лиз себе
+            self._renewer.stop()
+            await asyncio.to_thread(self._renewer.join, self.ttl)
+            self._renewer = None
+        self.token = None
+        db.set_fence(None)
+        try:
+            await self.on_demoted()
+        except Exception as e:
+            logger.error("%s: on_demoted failed: %s", self.holder, e)
+
+    async def _run(self) -> None:
+        last_warm = 0.0
+        while True:
+            if self.is_leader:
+                # продлевает _Renewer; здесь только ждём, не потерян ли лиз
+                await self._lost.wait()
+                await self._step_down()
+                continue
+            try:
+                token = await db.acquire_lease(self.name, self.holder, self.ttl)
+            except Exception as e:
+                logger.warning("lease acquire failed: %s", e)
+                token = None
+            if token is not None:
+                if not await self._become_leader(token):
+                    await asyncio.sleep(ELECT_RETRY)
+                continue
+
+            if self.warm and time.monotonic() - last_warm > WARM_EVERY:
+                last_warm = time.monotonic()
+                try:
+                    await self.warm()
+                except Exception as e:
+                    logger.warning("standby warm-up failed: %s", e)
+
+            await asyncio.sleep(self.standby_poll)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._loop = asyncio.get_running_loop()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self.is_leader:
+            await self._step_down()
+            # отпускаем лиз сразу — standby не ждёт TTL
+            await db.release_lease(self.name, self.holder)
+
+
+# ========= ЛОКАЛЬНЫЙ СТЕНД =========
+def _demo_instance(path: str, idx: int, events, ttl: float, renew: float) -> None:
+    logging.basicConfig(level=logging.INFO, format=f"[{idx}] %(message)s")
+
+    async def run():
+        await db.init_db(f"sqlite:///{path}")
+
+        async def elected(token):
+            events.put(("elected", idx, os.getpid(), token, time.time()))
+
+        async def demoted():
+            events.put(("demoted", idx, os.getpid(), None, time.time()))
+
+        el = LeaderElector(elected, demoted, holder=f"demo-{idx}", ttl=ttl, renew_every=renew, standby_poll=renew / 2)
+        el.start()
+        await asyncio.Event().wait()
+
+    asyncio.run(run())
+
+
+def demo(instances: int, path: str, kill_after: float, rounds: int, ttl: float = LEASE_TTL, renew: float = RENEW_EVERY) -> None:
+    """Поднимает N процессов, убивает (SIGKILL) лидера и меряет время перехвата."""
+    ctx = multiprocessing.get_context("spawn")
+    events = ctx.Queue()
+    procs = {i: ctx.Process(target=_demo_instance, args=(path, i, events, ttl, renew), daemon=True) for i in range(instances)}
+    for p in procs.values():
+        p.start()
+    try:
+        ev = events.get(timeout=30)
+        for _ in range(rounds):
+            while ev[0] != "elected":
+                ev = events.get(timeout=30)
+            _, idx, pid, token, _ts = ev
+            print(f"leader: instance {idx} (pid {pid}), token {token}")
+            time.sleep(kill_after)
+            procs[idx].kill()
+            killed_at = time.time()
+            ev = events.get(timeout=30)
+            print(f"killed {idx}; instance {ev[1]} took over with token {ev[3]} in {ev[4] - killed_at:.3f}s")
+    finally:
+        for p in procs.values():
+            p.kill()
+        events.cancel_join_thread()
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Leader election demo on one SQLite file")
+    ap.add_argument("--instances", type=int, default=3)
+    ap.add_argument("--db", default="ha_demo.db")
+    ap.add_argument("--kill-after", type=float, default=2.0)
+    ap.add_argument("--rounds", type=int, default=2)
+    ap.add_argument("--ttl", type=float, default=LEASE_TTL)
+    ap.add_argument("--renew", type=float, default=RENEW_EVERY)
+    args = ap.parse_args()
+    demo(args.instances, args.db, args.kill_after, min(args.rounds, args.instances - 1), args.ttl, args.renew)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+"""
+Здоровье event loop'а.
+
+* LoopMonitor — корутина-сэмплер: каждые SAMPLE_INTERVAL сек меряет, на
+  сколько позже запланированного её разбудили (лаг планировщика).
+* Поток-сторож: если loop не «тикал» дольше SLOW_CALLBACK_SEC, снимает стек
+  главного потока — видно, какой колбэк/хендлер держит loop.
+* Сторож watcher'а: замечает, что autobuy.watcher_loop пропускает тики.
+* install_loop_policy() — опциональный uvloop (pip install uvloop).
+"""
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from typing import Optional
+
+import autobuy
+
+logger = logging.getLogger("giftbot.loop")
+
+SAMPLE_INTERVAL = 0.1        # сек между замерами лага
+SAMPLES_KEEP = 3000          # ~5 минут истории при 0.1 сек
+SLOW_CALLBACK_SEC = 0.25     # порог «loop завис»
+WATCHER_GRACE = 3.0          # во сколько раз тик watcher'а может опоздать
+WATCHER_SLACK_SEC = 5.0      # + запас на сам опрос каталога
+
+
+def install_loop_policy(name: str) -> str:
+    """Ставит политику event loop'а до asyncio.run(). Возвращает фактическую."""
+    if name == "uvloop":
+        try:
+            import uvloop
+        except ImportError:
+            logger.warning("EVENT_LOOP=uvloop, but uvloop is not installed; using asyncio")
+            return "asyncio"
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        return "uvloop"
+    return "asyncio"
+
+
+def _percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    idx = min(len(values) - 1, int(round(q * (len(values) - 1))))
+    return values[idx]
+
+
+class LoopMonitor:
+    def __init__(
+        self,
+        sample_interval: float = SAMPLE_INTERVAL,
+        slow_callback_sec: float = SLOW_CALLBACK_SEC,
+    ):
+        self.sample_interval = sample_interval
+        self.slow_callback_sec = slow_callback_sec
+        self.samples: deque[float] = deque(maxlen=SAMPLES_KEEP)
+        self.stalls = 0
+        self.watcher_misses = 0
+        self.loop_impl = ""
+        self._heartbeat = time.monotonic()
+        self._loop_thread_id: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._watcher_alerted = False
+
+    # ----- сэмплер лага (внутри loop'а) -----
+    async def _sampler(self) -> None:
+        while True:
+            expected = time.monotonic() + self.sample_interval
+            await asyncio.sleep(self.sample_interval)
+            now = time.monotonic()
+            self.samples.append(max(0.0, now - expected))
+            self._heartbeat = now
+            self._check_watcher(now)
+
+    def _check_watcher(self, now: float) -> None:
+        last = autobuy.LAST_WATCHER_TICK
+        if last is None:
+            return
+        allowed = autobuy.current_poll_interval() * WATCHER_GRACE + WATCHER_SLACK_SEC
+        late = now - last
+        if late > allowed:
+            if not self._watcher_alerted:
+                self.watcher_misses += 1
+                self._watcher_alerted = True
+                logger.warning("watcher_loop missed ticks: last tick %.1fs ago (allowed %.1fs)", late, allowed)
+        else:
+            self._watcher_alerted = False
+
+    # ----- сторож зависаний (отдельный поток) -----
+    def _watchdog(self) -> None:
+        stalled = False
+        while not self._stop.wait(self.slow_callback_sec / 2):
+            blocked = time.monotonic() - self._heartbeat - self.sample_interval
+            if blocked > self.slow_callback_sec and not stalled:
+                stalled = True
+                self.stalls += 1
+                frame = sys._current_frames().get(self._loop_thread_id)
+                stack = "".join(traceback.format_stack(frame)) if frame else "<no frame>"
+                logger.warning("event loop blocked for %.3fs, stack:\n%s", blocked, stack)
+            elif blocked <= self.slow_callback_sec:
+                stalled = False
+
+    def start(self) -> None:
+        if self._task is not None:
+            return
+        loop = asyncio.get_running_loop()
+        self.loop_impl = f"{type(loop).__module__}.{type(loop).__name__}"
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._task = asyncio.create_task(self._sampler())
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._watchdog, name="loop-watchdog", daemon=True)
+        self._thread.start()
+
+    async def stop(self) -> None:
+        self._stop.set()
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._thread:
+            self._thread.join(timeout=1)
+            self._thread = None
+
+    def reset(self) -> None:
+        self.samples.clear()
+        self.stalls = 0
+        self.watcher_misses = 0
+
+    def stats(self) -> dict:
+        values = sorted(self.samples)
+        return {
+            "loop": self.loop_impl,
+            "samples": len(values),
+            "p50_ms": _percentile(values, 0.50) * 1000,
+            "p95_ms": _percentile(values, 0.95) * 1000,
+            "p99_ms": _percentile(values, 0.99) * 1000,
+            "max_ms": (values[-1] if values else 0.0) * 1000,
+            "stalls": self.stalls,
+            "watcher_misses": self.watcher_misses,
+        }
+
+
+monitor = LoopMonitor()
@@ -1,5 +1,6 @@
 import asyncio
 import logging
+import os
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
@@ -10,6 +11,15 @@ from settings import settings
 import db
 from payments import router as payments_router
 import autobuy
+import webhook
+import journal
+import loopmon
+import leader
+import rules_engine
+import broadcast
+import profiler
+import sources
+import snapshot
 
 import json
 from html import escape
@@ -32,6 +42,9 @@ dp.include_router(payments_router)
 # Глобальный watcher
 _watcher_stop = asyncio.Event()
 _watcher_task: asyncio.Task | None = None
+_webhook: webhook.WebhookHandler | None = None
+_elector: leader.LeaderElector | None = None
+_detector: sources.MultiSourceDetector | None = None
 
 def _is_admin(user_id: int) -> bool:
     return int(user_id) == int(settings.ADMIN_ID)
@@ -50,16 +63,27 @@ async def cmd_start(m: types.Message):
     "/buy [сумма] — пополнить баланс звёздами\n"
     "/balance — показать баланс\n"
     "/autobuy_on — включить автоскуп\n"
-    "/autobuy_off — выключить автоскуп\n\n"
+    "/autobuy_off — выключить автоскуп\n"
+    "/subscribe — уведомлять о новых подарках\n"
+    "/unsubscribe — не уведомлять\n\n"
     "Правила автоскупа:\n"
     "/rules — показать текущие правила\n"
     "/rules_price &lt;min&gt; &lt;max&gt; — задать ценовой диапазон в ⭐\n"
+    "/copies &lt;N&gt; — сколько копий каждого нового подарка брать\n"
     "/limited_on — покупать только лимитные с остатком\n"
-    "/limited_off — разрешить и обычные (не рекомендовано)\n\n"
+    "/limited_off — разрешить и обычные (не рекомендовано)\n"
+    "/rule_add key=value … — доп. правило (min, max, gift, copies, limited, daily, drop)\n"
+    "/rule_del &lt;id&gt; — удалить доп. правило\n\n"
     "Скорость (только для админа):\n"
     "/speed_fast [сек] — турбо-режим (по умолчанию 180 сек)\n"
     "/speed_base [сек] — базовый интервал (по умолчанию 10 сек)\n"
-    "/speed_status — текущие интервалы"
+    "/speed_status — текущие интервалы\n"
+    "/loop_stats [reset] — лаг event loop'а\n"
+    "/profile &lt;сек&gt; [sample] — профиль живого бота\n"
+    "/tasks — дамп asyncio-задач\n"
+    "/sources — какой источник каталога быстрее\n"
+    "/sellthrough [мин] — самые быстро распродаваемые подарки\n"
+    "/gift_velocity &lt;gift_id&gt; [мин] — темп распродажи подарка"
     )
     await m.answer(text, reply_markup=kb.as_markup())
 
@@ -85,18 +109,143 @@ async def cmd_ab_off(m: types.Message):
     await db.set_autobuy(m.from_user.id, False)
     await m.answer("Автоскуп выключен.")
 
+# ---------- Подписка на новые подарки ----------
+@dp.message(F.text == "/subscribe")
+async def cmd_subscribe(m: types.Message):
+    await db.ensure_user(m.from_user.id, m.from_user.username)
+    await db.set_subscribed(m.from_user.id, True)
+    await m.answer("🔔 Подписка включена: сообщу, как только появится новый подарок.")
+
+@dp.message(F.text == "/unsubscribe")
+async def cmd_unsubscribe(m: types.Message):
+    await db.set_subscribed(m.from_user.id, False)
+    await m.answer("🔕 Подписка выключена.")
+
+@dp.message(F.text == "/broadcast_status")
+async def cmd_broadcast_status(m: types.Message):
+    if not _is_admin(m.from_user.id):
+        return await m.answer("Эта команда доступна только админу.")
+    b = broadcast.broadcaster
+    lines = [f"Подписчиков: {await db.count_subscribers()}"]
+    if b.current:
+        lines.append(
+            f"Идёт рассылка #{b.current}: {b.rate():.1f} сообщ./сек, "
+            f"пауз ради покупок {b.paused_for_purchases:.1f} сек"
+        )
+    for r in await db.recent_broadcasts():
+        done = r["sent"] + r["failed"] + r["blocked"]
+        pct = done * 100 // r["total"] if r["total"] else 100
+        lines.append(
+            f"#{r['id']} [{r['status']}] {done}/{r['total']} ({pct}%): "
+            f"✅ {r['sent']} ❌ {r['failed']} 🚫 {r['blocked']}"
+        )
+    await m.answer("\n".join(lines))
+
 # ---------- Правила ----------
 @dp.message(F.text == "/rules")
 async def cmd_rules_show(m: types.Message):
     await db.ensure_user(m.from_user.id, m.from_user.username)
     r = await db.get_rules(m.from_user.id)
     only_limited = "Да (только лимитные)" if r["only_limited"] else "Нет (разрешены обычные)"
+    extra = await db.list_rules(m.from_user.id)
+    if extra:
+        lines = ["Расширенные правила (базовое не действует):"]
+        lines += [f"#{x['id']}: {_format_rule(x)}" for x in extra]
+        if any(x["daily_budget"] is not None or x["drop_budget"] is not None for x in extra):
+            lines.append(_BUDGET_NOTE)
+        lines.append("Удалить: /rule_del &lt;id&gt;")
+        return await m.answer("\n".join(lines))
     await m.answer(
         f"Текущие правила:\n"
         f"• Только лимитные: <b>{only_limited}</b>\n"
-        f"• Цена: <b>{r['min_price']} — {r['max_price']}</b> ⭐"
+        f"• Цена: <b>{r['min_price']} — {r['max_price']}</b> ⭐\n"
+        f"• Копий каждого подарка: <b>{r['copies']}</b>"
+    )
+
+@dp.message(F.text.startswith("/copies"))
+async def cmd_copies(m: types.Message):
+    await db.ensure_user(m.from_user.id, m.from_user.username)
+    parts = m.text.split()
+    if len(parts) < 2 or not parts[1].isdigit() or int(parts[1]) < 1:
+        return await m.answer(f"Использование: /copies &lt;N&gt; (1–{db.MAX_COPIES})")
+    await db.set_copies(m.from_user.id, int(parts[1]))
+    r = await db.get_rules(m.from_user.id)
+    await m.answer(
+        f"OK. Каждого нового подарка беру до <b>{r['copies']}</b> шт. "
+        f"(баланс резервируется сразу под все копии)"
     )
 
+# ключ в команде -> (колонка user_rules, тип)
+_RULE_KEYS = {
+    "min": ("min_price", int),
+    "max": ("max_price", int),
+    "gift": ("gift_id", str),
+    "copies": ("max_copies", int),
+    "limited": ("only_limited", int),
+    "daily": ("daily_budget", int),
+    "drop": ("drop_budget", int),
+}
+
+def _parse_rule_args(text: str) -> dict:
+    fields = {}
+    for part in text.split()[1:]:
+        key, sep, val = part.partition("=")
+        if not sep or key not in _RULE_KEYS:
+            raise ValueError(part)
+        col, typ = _RULE_KEYS[key]
+        fields[col] = typ(val)
+        if typ is int and fields[col] < 0:
+            raise ValueError(part)
+    if fields.get("min_price", 0) > fields.get("max_price", 1000000000):
+        fields["min_price"], fields["max_price"] = fields["max_price"], fields["min_price"]
+    return fields
+
+def _format_rule(x) -> str:
+    parts = [f"цена {x['min_price']} — {x['max_price']} ⭐"]
+    if x["gift_id"]:
+        parts.append(f"подарок <code>{escape(x['gift_id'])}</code>")
+    if x["max_copies"] > 1:
+        parts.append(f"до {x['max_copies']} копий")
+    if x["only_limited"]:
+        parts.append("только лимитные")
+    if x["daily_budget"] is not None:
+        parts.append(f"{x['daily_budget']} ⭐/сутки*")
+    if x["drop_budget"] is not None:
+        parts.append(f"{x['drop_budget']} ⭐/дроп*")
+    return ", ".join(parts)
+
+# бюджеты daily/drop — на пользователя, а не на правило (см. rules_engine.compile_rules)
+_BUDGET_NOTE = "* бюджеты общие для всех ваших правил: действует самый строгий из заданных"
+
+@dp.message(F.text.startswith("/rule_add"))
+async def cmd_rule_add(m: types.Message):
+    await db.ensure_user(m.from_user.id, m.from_user.username)
+    try:
+        fields = _parse_rule_args(m.text)
+    except ValueError:
+        fields = None
+    if not fields:
+        return await m.answer(
+            "Использование: /rule_add min=100 max=5000 gift=&lt;id&gt; copies=2 "
+            "limited=1 daily=10000 drop=3000\n(любые ключи можно опустить; "
+            f"copies — до {db.MAX_COPIES})\n"
+            "daily/drop — бюджет на пользователя, а не на это правило: "
+            "действует самый строгий из всех ваших правил"
+        )
+    rule_id = await db.add_rule(m.from_user.id, **fields)
+    note = f"\n{_BUDGET_NOTE}" if "daily_budget" in fields or "drop_budget" in fields else ""
+    await m.answer(f"Правило #{rule_id} добавлено.{note}")
+
+@dp.message(F.text.startswith("/rule_del"))
+async def cmd_rule_del(m: types.Message):
+    parts = m.text.split()
+    if len(parts) < 2 or not parts[1].isdigit():
+        return await m.answer("Использование: /rule_del &lt;id&gt;")
+    if await db.delete_rule(m.from_user.id, int(parts[1])):
+        await m.answer(f"Правило #{parts[1]} удалено.")
+    else:
+        await m.answer("Нет такого правила.")
+
 @dp.message(F.text.startswith("/rules_price"))
 async def cmd_rules_price(m: types.Message):
     parts = m.text.strip().split()
@@ -125,6 +274,80 @@ async def cmd_debug_gifts(m: types.Message):
         await m.answer_document(buf, caption="Raw getAvailableGifts")
 
 
+@dp.message(F.text.startswith("/profile"))
+async def cmd_profile(m: types.Message):
+    if not _is_admin(m.from_user.id):
+        return await m.answer("Эта команда доступна только админу.")
+    # /profile <сек> [sample]
+    parts = m.text.split()
+    if len(parts) < 2 or not parts[1].isdigit():
+        return await m.answer(f"Использование: /profile &lt;сек&gt; [sample] (до {profiler.MAX_SECONDS} сек)")
+    if profiler.busy():
+        return await m.answer("Профилирование уже идёт.")
+    mode = "sample" if len(parts) > 2 and parts[2] == "sample" else "cprofile"
+    seconds = min(profiler.MAX_SECONDS, max(1, int(parts[1])))
+    await m.answer(f"⏱ Профилирую ({mode}) {seconds} сек…")
+    res = await profiler.profile(seconds, mode)
+
+    caption = f"Profile {mode}, {res.seconds:.0f}s"
+    if len(res.summary) < 3800:
+        await m.answer(f"<b>Top {profiler.TOP_N}</b>\n<pre>{escape(res.summary)}</pre>")
+    buf = BufferedInputFile(res.report.encode("utf-8"), filename=f"profile_{mode}.txt")
+    await m.answer_document(buf, caption=caption)
+    if res.raw:
+        await m.answer_document(BufferedInputFile(res.raw, filename="profile.prof"), caption="pstats / snakeviz")
+
+@dp.message(F.text == "/sources")
+async def cmd_sources(m: types.Message):
+    if not _is_admin(m.from_user.id):
+        return await m.answer("Эта команда доступна только админу.")
+    if _detector is None:
+        return await m.answer(f"Источник один: {escape(settings.GIFT_SOURCES)}")
+    await m.answer("Источники каталога:\n" + "\n".join(escape(x) for x in _detector.stats_lines()))
+
+@dp.message(F.text == "/tasks")
+async def cmd_tasks(m: types.Message):
+    if not _is_admin(m.from_user.id):
+        return await m.answer("Эта команда доступна только админу.")
+    dump = profiler.dump_tasks()
+    buf = BufferedInputFile(dump.encode("utf-8"), filename="asyncio_tasks.txt")
+    await m.answer_document(buf, caption=dump.split("\n", 1)[0])
+
+def _format_sell_through(rows: list, minutes: int) -> str:
+    lines = [f"Скорость распродажи за {minutes} мин:"]
+    for st in rows:
+        lines.append(
+            f"• <code>{escape(st.gift_id)}</code>: {st.per_min:.1f}/мин, "
+            f"продано {st.sold}, осталось {st.last_supply}, "
+            f"до нуля ~{journal.format_eta(st.eta_sec)}"
+        )
+    return "\n".join(lines)
+
+@dp.message(F.text.startswith("/sellthrough"))
+async def cmd_sellthrough(m: types.Message):
+    if not _is_admin(m.from_user.id):
+        return await m.answer("Эта команда доступна только админу.")
+    parts = m.text.split()
+    minutes = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else 60
+    rows = await journal.top_velocity(max(1, minutes) * 60)
+    if not rows:
+        return await m.answer(f"За {minutes} мин остатки не менялись.")
+    await m.answer(_format_sell_through(rows, minutes))
+
+@dp.message(F.text.startswith("/gift_velocity"))
+async def cmd_gift_velocity(m: types.Message):
+    if not _is_admin(m.from_user.id):
+        return await m.answer("Эта команда доступна только админу.")
+    parts = m.text.split()
+    if len(parts) < 2:
+        return await m.answer("Использование: /gift_velocity &lt;gift_id&gt; [минут]")
+    gift_id = parts[1]
+    minutes = int(parts[2]) if len(parts) > 2 and parts[2].isdigit() else 60
+    st = await journal.velocity(gift_id, max(1, minutes) * 60)
+    if st is None:
+        return await m.answer(f"По {escape(gift_id)} нет данных об остатке за {minutes} мин.")
+    await m.answer(_format_sell_through([st], minutes))
+
 @dp.message(F.text == "/limited_on")
 async def cmd_limited_on(m: types.Message):
     await db.set_only_limited(m.from_user.id, True)
@@ -143,6 +366,7 @@ async def cmd_speed_fast(m: types.Message):
     parts = m.text.split()
     seconds = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else 180
     autobuy.enable_turbo(seconds)
+    await autobuy.publish_poll_settings()
     await m.answer(f"🚀 Турбо включён на {seconds} сек. Текущий интервал: {autobuy.current_poll_interval():.2f} сек")
 
 @dp.message(F.text.startswith("/speed_base"))
@@ -155,52 +379,228 @@ async def cmd_speed_base(m: types.Message):
     except ValueError:
         seconds = 10.0
     autobuy.set_base_interval(seconds)
+    await autobuy.publish_poll_settings()
     await m.answer(f"Базовый интервал опроса установлен: {seconds:.2f} сек")
 
 @dp.message(F.text == "/speed_status")
 async def cmd_speed_status(m: types.Message):
+    if settings.HA_ENABLED:
+        await autobuy.sync_poll_settings()
     await m.answer(
         f"Текущий интервал: {autobuy.current_poll_interval():.2f} сек\n"
         f"База: {autobuy.POLL_BASE_INTERVAL:.2f} сек\n"
         f"Турбо осталось: {autobuy.turbo_remaining()} сек"
+        + _webhook_status()
+        + _loop_status()
+        + _ha_status()
+        + _snapshot_status()
+    )
+
+def _ha_status() -> str:
+    if _elector is None:
+        return ""
+    role = f"лидер (token {_elector.token})" if _elector.is_leader else "standby"
+    return f"\nИнстанс {escape(_elector.holder)}: {role}"
+
+def _snapshot_status() -> str:
+    sn = snapshot.snapshotter
+    if not sn.path:
+        return ""
+    line = f"\nСнапшот: {sn.saves} записей, {sn.last_size} байт"
+    if sn.restored:
+        r = sn.restored
+        line += f"; при старте восстановлен за {r.took_ms:.1f} мс (возраст {r.age:.1f} сек)"
+    return line
+
+def _loop_status() -> str:
+    st = loopmon.monitor.stats()
+    if not st["samples"]:
+        return ""
+    return (
+        f"\nLoop lag ({st['loop']}): p50 {st['p50_ms']:.1f} / p95 {st['p95_ms']:.1f} / "
+        f"p99 {st['p99_ms']:.1f} / max {st['max_ms']:.1f} мс"
+    )
+
+@dp.message(F.text.startswith("/loop_stats"))
+async def cmd_loop_stats(m: types.Message):
+    if not _is_admin(m.from_user.id):
+        return await m.answer("Эта команда доступна только админу.")
+    # /loop_stats reset — начать окно заново (сравнить до/после)
+    if m.text.split()[-1] == "reset":
+        loopmon.monitor.reset()
+        return await m.answer("Статистика loop'а сброшена.")
+    st = loopmon.monitor.stats()
+    await m.answer(
+        f"Event loop: <code>{escape(st['loop'])}</code>\n"
+        f"Замеров: {st['samples']}\n"
+        f"Лаг p50: {st['p50_ms']:.2f} мс\n"
+        f"Лаг p95: {st['p95_ms']:.2f} мс\n"
+        f"Лаг p99: {st['p99_ms']:.2f} мс\n"
+        f"Лаг max: {st['max_ms']:.2f} мс\n"
+        f"Зависаний &gt; {loopmon.SLOW_CALLBACK_SEC * 1000:.0f} мс: {st['stalls']}\n"
+        f"Пропусков тиков watcher'а: {st['watcher_misses']}"
+    )
+
+def _webhook_status() -> str:
+    if _webhook is None:
+        return ""
+    st = _webhook.stats()
+    return (
+        f"\nWebhook: {st['processed']}/{st['received']} обработано, очередь {st['queued']}, "
+        f"воркеров {st['workers']}, ожидание {st['avg_wait_ms']:.1f} мс, "
+        f"обработка {st['avg_handle_ms']:.1f} мс"
     )
 
 
 # ---------- Watcher lifecycle ----------
+def _source_names() -> list[str]:
+    return [x.strip() for x in settings.GIFT_SOURCES.split(",") if x.strip()]
+
+async def _on_new_gifts(gifts: list[dict]):
+    await autobuy.handle_new_gifts(bot, gifts)
+
+_resume_tasks: set[asyncio.Task] = set()
+
 async def start_watcher():
-    global _watcher_task
+    global _watcher_task, _detector
     _watcher_stop.clear()
-    _watcher_task = asyncio.create_task(autobuy.watcher_loop(bot, _watcher_stop))
+    # резервы звёзд, брошенные упавшим процессом (этим или прежним лидером)
+    refunded = await db.refund_open_reservations()
+    if refunded:
+        await db.log("WARN", f"Refunded {refunded} ⭐ of interrupted reservations")
+    # дропы, прерванные рестартом (снапшот) или падением прежнего лидера (общая БД);
+    # читаем до старта watcher'а, иначе его свежий дроп попал бы сюда же
+    pending = {str(g["id"]): g for g in snapshot.snapshotter.take_pending()}
+    for g in await db.unfinished_drops(snapshot.RESUME_MAX_AGE):
+        pending.setdefault(g["id"], g)
+    pending = list(pending.values())
+    names = _source_names()
+    if names == ["botapi"]:
+        _watcher_task = asyncio.create_task(autobuy.watcher_loop(bot, _watcher_stop))
+    else:
+        # несколько источников: покупаем по первому, кто увидел новый подарок
+        _detector = sources.MultiSourceDetector(
+            sources.build_sources(names, settings.GIFT_ENDPOINT_URL), _on_new_gifts
+        )
+        _watcher_task = asyncio.create_task(_detector.run(_watcher_stop))
+    broadcast.broadcaster.start(bot)   # рассылки — там же, где watcher (только у лидера)
+    if pending:
+        # докупаем, уже отправленное не повторится
+        _resume_tasks.add(t := asyncio.create_task(autobuy.resume_drops(bot, pending)))
+        t.add_done_callback(_resume_tasks.discard)
 
 async def stop_watcher():
     _watcher_stop.set()
+    if _resume_tasks:
+        await asyncio.gather(*_resume_tasks, return_exceptions=True)
+    await broadcast.broadcaster.stop()
     if _watcher_task:
         try:
             await _watcher_task
         except Exception:
             pass
 
+async def _on_elected(token: int):
+    await start_watcher()
+    try:
+        await bot.send_message(settings.LOG_CHAT_ID, f"👑 {escape(_elector.holder)} стал лидером (token {token})")
+    except Exception:
+        pass
+
+async def _warm_standby():
+    # standby: держим HTTP-сессию и скомпилированные правила готовыми к перехвату
+    await autobuy.init_http()
+    await rules_engine.get_compiled()
+
+def _snapshot_path() -> str:
+    # у каждого инстанса свой файл, иначе инстансы на одном хосте затирают друг друга
+    path = settings.STATE_SNAPSHOT_PATH
+    if path and settings.INSTANCE_ID:
+        root, ext = os.path.splitext(path)
+        path = f"{root}.{settings.INSTANCE_ID}{ext}"
+    return path
+
+async def _restore_snapshot():
+    # до первого опроса: турбо, слоты лимитера и flood-gate — как до рестарта
+    path = _snapshot_path()
+    if not path:
+        return
+    info = snapshot.snapshotter.restored = snapshot.restore(path)
+    if info:
+        await db.log(
+            "INFO",
+            f"State snapshot restored in {info.took_ms:.1f} ms (age {info.age:.1f}s, "
+            f"turbo {info.turbo_left}s, {info.chats} chat slots)",
+        )
+        if info.pending_drops:
+            # докупит тот, кто запустит watcher (см. start_watcher)
+            ids = ", ".join(str(g["id"]) for g in info.pending_drops)
+            await db.log("WARN", f"Restart interrupted purchases for gifts: {ids}")
+    snapshot.snapshotter.start(path)
+
 async def on_startup():
+    global _elector
     await db.init_db(settings.DATABASE_URL)
+    await _restore_snapshot()
     await autobuy.init_http()          # единая HTTP-сессия
-    await start_watcher()
+    await rules_engine.get_compiled()  # правила компилируем до первого дропа, а не во время
+    loopmon.monitor.start()
+    if settings.HA_ENABLED:
+        _elector = leader.LeaderElector(
+            _on_elected, stop_watcher, warm=_warm_standby, holder=settings.INSTANCE_ID or None,
+            ttl=settings.LEASE_TTL, renew_every=settings.LEASE_RENEW, standby_poll=settings.LEASE_RENEW / 2,
+        )
+        _elector.start()
+    else:
+        await start_watcher()
     try:
         await bot.send_message(settings.LOG_CHAT_ID, f"🚀 Бот запущен. TZ={settings.TIMEZONE}")
     except Exception:
         pass
 
 async def on_shutdown():
-    await stop_watcher()
+    if _elector is not None:
+        await _elector.stop()          # остановит watcher и отпустит лиз
+    else:
+        await stop_watcher()
+    await snapshot.snapshotter.stop()  # финальный снапшот — после того, как докупили
     await autobuy.close_http()         # закрываем HTTP-сессию
+    await loopmon.monitor.stop()
+
+async def _run_webhook():
+    global _webhook
+    if not settings.WEBHOOK_URL:
+        raise RuntimeError("UPDATES_MODE=webhook requires WEBHOOK_URL")
+    if not settings.WEBHOOK_SECRET:
+        raise RuntimeError("UPDATES_MODE=webhook requires WEBHOOK_SECRET")
+    _webhook = webhook.WebhookHandler(
+        dp, bot, secret=settings.WEBHOOK_SECRET, workers=settings.WEBHOOK_WORKERS
+    )
+    await webhook.run_webhook(
+        _webhook,
+        url=settings.WEBHOOK_URL,
+        host=settings.WEBHOOK_HOST,
+        port=settings.WEBHOOK_PORT,
+        path=settings.WEBHOOK_PATH,
+    )
 
 async def main():
+    if settings.HA_ENABLED and settings.UPDATES_MODE != "webhook":
+        # getUpdates допускает только одного поллера на токен — инстансы конфликтовали бы
+        raise RuntimeError("HA_ENABLED=1 requires UPDATES_MODE=webhook")
     await on_startup()
     try:
-        await dp.start_polling(bot)
+        if settings.UPDATES_MODE == "webhook":
+            await _run_webhook()
+        else:
+            # вебхук мог остаться от прошлого запуска — иначе getUpdates вернёт конфликт
+            await bot.delete_webhook(drop_pending_updates=False)
+            await dp.start_polling(bot)
     finally:
         await on_shutdown()
 
 if __name__ == "__main__":
+    logger.info("Event loop: %s", loopmon.install_loop_policy(settings.EVENT_LOOP))
     try:
         asyncio.run(main())
     except (KeyboardInterrupt, SystemExit):
@@ -0,0 +1,137 @@
+"""
+Профилирование живого бота по команде админа.
+
+* cprofile — cProfile на потоке event loop'а: watcher, хендлеры, колбэки.
+* sample   — поток-сэмплер снимает стеки всех потоков (в т.ч. воркеров
+             aiosqlite) каждые SAMPLE_INTERVAL сек; накладные почти нулевые.
+* dump_tasks() — стеки всех asyncio-задач.
+
+Вне окна профилирования ничего не установлено — накладных расходов нет.
+"""
+import asyncio
+import cProfile
+import io
+import marshal
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass
+
+MAX_SECONDS = 120
+SAMPLE_INTERVAL = 0.005
+TOP_N = 15
+# листовые кадры «поток ждёт» — в топ не попадают, считаются отдельно
+_IDLE_LEAVES = ("select (", "poll (", "wait (", "_wait_for_tstate_lock (")
+
+_lock = asyncio.Lock()
+
+
+@dataclass
+class ProfileResult:
+    mode: str
+    seconds: float
+    summary: str       # короткий топ для подписи
+    report: str        # полный текстовый отчёт
+    raw: bytes = b""   # .prof для snakeviz (только cprofile)
+
+
+def busy() -> bool:
+    return _lock.locked()
+
+
+# ========= cProfile =========
+async def _run_cprofile(seconds: float) -> ProfileResult:
+    prof = cProfile.Profile()
+    prof.enable()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        prof.disable()
+
+    out = io.StringIO()
+    stats = pstats.Stats(prof, stream=out)
+    stats.sort_stats("tottime").print_stats(TOP_N * 2)
+    stats.sort_stats("cumulative").print_stats(TOP_N * 2)
+
+    rows = sorted(stats.stats.items(), key=lambda kv: kv[1][2], reverse=True)[:TOP_N]
+    summary = "\n".join(
+        f"{tt * 1000:8.1f} мс  {nc:>7}×  {func}:{line}({_short(file)})"
+        for (file, line, func), (cc, nc, tt, ct, callers) in rows
+    )
+    return ProfileResult("cprofile", seconds, summary, out.getvalue(), marshal.dumps(stats.stats))
+
+
+def _short(path: str) -> str:
+    parts = path.replace("\\", "/").split("/")
+    return "/".join(parts[-2:])
+
+
+# ========= сэмплер =========
+def _sampler(stop: threading.Event, counts: Counter, leaf: Counter, meta: dict) -> None:
+    own_ident = threading.get_ident()
+    while not stop.wait(SAMPLE_INTERVAL):
+        meta["samples"] += 1
+        for ident, frame in sys._current_frames().items():
+            if ident == own_ident:
+                continue
+            stack = []
+            f = frame
+            while f is not None:
+                code = f.f_code
+                stack.append(f"{code.co_name} ({_short(code.co_filename)}:{f.f_lineno})")
+                f = f.f_back
+            if not stack:
+                continue
+            if stack[0].startswith(_IDLE_LEAVES):
+                meta["idle"] += 1
+                continue
+            name = meta["threads"].get(ident, str(ident))
+            leaf[f"[{name}] {stack[0]}"] += 1
+            counts[f"[{name}] " + ";".join(reversed(stack))] += 1
+
+
+async def _run_sampler(seconds: float) -> ProfileResult:
+    stop = threading.Event()
+    counts: Counter = Counter()
+    leaf: Counter = Counter()
+    meta = {"samples": 0, "idle": 0, "threads": {t.ident: t.name for t in threading.enumerate()}}
+    th = threading.Thread(target=_sampler, args=(stop, counts, leaf, meta), name="profiler-sampler", daemon=True)
+    th.start()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        stop.set()
+        th.join(timeout=1)
+
+    total = max(1, meta["samples"])
+    summary = "\n".join(f"{n * 100 / total:5.1f}%  {where}" for where, n in leaf.most_common(TOP_N))
+    # collapsed stacks — формат flamegraph.pl / speedscope
+    collapsed = "\n".join(f"{stack} {n}" for stack, n in counts.most_common())
+    report = (
+        f"samples: {meta['samples']} @ {SAMPLE_INTERVAL * 1000:.0f} ms, idle thread-samples: {meta['idle']}\n\n"
+        f"Top leaf frames:\n{summary}\n\nCollapsed stacks:\n{collapsed}\n"
+    )
+    return ProfileResult("sample", seconds, summary, report)
+
+
+async def profile(seconds: float, mode: str = "cprofile") -> ProfileResult:
+    seconds = min(MAX_SECONDS, max(1.0, float(seconds)))
+    async with _lock:
+        if mode == "sample":
+            return await _run_sampler(seconds)
+        return await _run_cprofile(seconds)
+
+
+# ========= asyncio-задачи =========
+def dump_tasks() -> str:
+    out = io.StringIO()
+    tasks = sorted(asyncio.all_tasks(), key=lambda t: t.get_name())
+    out.write(f"{len(tasks)} tasks @ {time.strftime('%Y-%m-%d %H:%M:%S')}\n\n")
+    for t in tasks:
+        coro = t.get_coro()
+        out.write(f"--- {t.get_name()} ({getattr(coro, '__qualname__', coro)}) done={t.done()}\n")
+        t.print_stack(limit=20, file=out)
+        out.write("\n")
+    return out.getvalue()
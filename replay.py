@@ -0,0 +1,331 @@
+"""
+Офлайн-реплей дропов через путь принятия решений автобая.
+
+Берёт записанные снимки каталога и фикстуру пользователей/правил, гоняет их
+через настоящие db.apply_catalog_snapshot -> rules_engine.plan_purchases ->
+autobuy.execute_decisions на временной SQLite, а отправка идёт в «нулевой»
+отправитель на виртуальных часах с теми же лимитами, что и send_gift.
+Звёзды не тратятся, сеть не нужна.
+
+Снимки (--snapshots):
+  * JSON-файл с ответом getAvailableGifts (дамп /debug_gifts) — один снимок;
+  * JSON-файл со списком [{"ts": 0.0, "response": {...}} | {"ts": 0.0, "gifts": [...]}];
+  * каталог с *.json дампами (по имени файла, шаг --interval сек);
+  * SQLite-база бота (*.db) — снимки восстанавливаются из catalog_journal.
+
+Фикстура (--fixture):
+  {"users": [{"user_id": 1, "balance": 5000, "only_limited": 0, "copies": 3,
+              "min_price": 0, "max_price": 100000,
+              "rules": [{"max_price": 500, "max_copies": 2, "drop_budget": 1000}]}]}
+
+    python replay.py --snapshots dumps/ --fixture users.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import sqlite3
+import tempfile
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Optional
+
+# симулятор не ходит в Bot API, но autobuy читает settings при импорте
+os.environ.setdefault("BOT_TOKEN", "0:replay")
+
+import autobuy
+import db
+import rules_engine
+
+
+# ========= ВИРТУАЛЬНОЕ ВРЕМЯ =========
+class VirtualClock:
+    def __init__(self, start: float = 0.0):
+        self.now = start
+
+    def advance_to(self, t: float) -> None:
+        self.now = max(self.now, t)
+
+
+class VirtualRateLimiter:
+    """Тот же алгоритм, что autobuy._rate_limit, но время виртуальное."""
+
+    def __init__(self, clock: VirtualClock, global_rps: float, per_chat_interval: float):
+        self.clock = clock
+        self.global_gap = 1.0 / global_rps
+        self.per_chat_interval = per_chat_interval
+        self.global_last = float("-inf")
+        self.per_chat_last: dict[int, float] = {}
+
+    def acquire(self, chat_id: Optional[int] = None) -> float:
+        """Резервирует слот и возвращает его виртуальное время (часы не двигает)."""
+        now = self.clock.now
+        wait = max(0.0, self.global_last + self.global_gap - now)
+        if chat_id is not None:
+            last = self.per_chat_last.get(chat_id, float("-inf"))
+            wait = max(wait, last + self.per_chat_interval - now)
+            self.per_chat_last[chat_id] = now + wait
+        self.global_last = now + wait
+        return now + wait
+
+
+@dataclass
+class SentRecord:
+    drop: int
+    user_id: int
+    gift_id: str
+    t: float            # виртуальное время завершения отправки
+
+
+class NullSender:
+    """
+    Вместо sendGift: берёт слот лимитера, добавляет latency и уменьшает
+    остаток подарка. Когда остаток кончился — SEND_SOLD_OUT, как у живого API.
+    Отправки пайплайна идут параллельно, поэтому время каждой считается от
+    её слота, а не от общих часов.
+    """
+
+    def __init__(self, clock: VirtualClock, limiter: VirtualRateLimiter, latency: float):
+        self.clock = clock
+        self.limiter = limiter
+        self.latency = latency
+        self.drop = 0
+        self.supply: dict[str, Optional[int]] = {}
+        self.sent: list[SentRecord] = []
+        self.sold_out = 0
+
+    async def __call__(self, user_id: int, gift_id: str, text: str = "") -> str:
+        done = self.limiter.acquire(user_id) + self.latency
+        left = self.supply.get(gift_id)
+        if left is not None:
+            if left <= 0:
+                self.sold_out += 1
+                return autobuy.SEND_SOLD_OUT
+            self.supply[gift_id] = left - 1
+        self.sent.append(SentRecord(self.drop, user_id, gift_id, done))
+        return autobuy.SEND_OK
+
+
+# ========= ЗАГРУЗКА СНИМКОВ =========
+def _gifts_from_entry(entry: dict) -> list[dict]:
+    if "gifts" in entry and isinstance(entry["gifts"], list):
+        return entry["gifts"]
+    return autobuy.normalize_gifts(entry.get("response", entry))
+
+
+def _snapshots_from_journal(path: Path) -> list[tuple[float, list[dict]]]:
+    conn = sqlite3.connect(path)
+    try:
+        rows = conn.execute(
+            "SELECT ts, gift_id, kind, price, supply FROM catalog_journal ORDER BY ts"
+        ).fetchall()
+    finally:
+        conn.close()
+    state: dict[str, dict] = {}
+    out: list[tuple[float, list[dict]]] = []
+    for i, (ts, gid, kind, price, supply) in enumerate(rows):
+        if kind == db.J_REMOVED:
+            state.pop(gid, None)
+        else:
+            state[gid] = {
+                "id": gid, "title": "Gift", "price": int(price or 0),
+                "limited": supply is not None, "supply": supply,
+            }
+        # снимок — после всех событий с одинаковым ts
+        if i + 1 == len(rows) or rows[i + 1][0] != ts:
+            out.append((ts / 1000.0, [dict(g) for g in state.values()]))
+    return out
+
+
+def load_snapshots(path: str, interval: float = 1.0) -> list[tuple[float, list[dict]]]:
+    """Возвращает [(ts_sec, gifts)] по возрастанию ts."""
+    p = Path(path)
+    if p.is_dir():
+        files = sorted(p.glob("*.json"))
+        return [
+            (i * interval, _gifts_from_entry(json.loads(f.read_text("utf-8"))))
+            for i, f in enumerate(files)
+        ]
+    if p.suffix in (".db", ".sqlite", ".sqlite3"):
+        return _snapshots_from_journal(p)
+    data = json.loads(p.read_text("utf-8"))
+    if isinstance(data, list):
+        return sorted(
+            ((float(e.get("ts", i * interval)), _gifts_from_entry(e)) for i, e in enumerate(data)),
+            key=lambda x: x[0],
+        )
+    return [(0.0, _gifts_from_entry(data))]
+
+
+async def seed_fixture(fixture: dict) -> None:
+    for u in fixture.get("users", []):
+        uid = int(u["user_id"])
+        await db.ensure_user(uid, u.get("username"))
+        await db.set_autobuy(uid, bool(u.get("autobuy", True)))
+        await db.add_balance(uid, int(u.get("balance", 0)))
+        if "min_price" in u or "max_price" in u:
+            await db.set_price_range(uid, int(u.get("min_price", 0)), int(u.get("max_price", 1000000000)))
+        if "only_limited" in u:
+            await db.set_only_limited(uid, bool(u["only_limited"]))
+        if "copies" in u:
+            await db.set_copies(uid, int(u["copies"]))
+        for r in u.get("rules", []):
+            await db.add_rule(uid, **{k: v for k, v in r.items() if k in db.RULE_FIELDS})
+
+
+# ========= ПРОГОН =========
+@dataclass
+class ReplayReport:
+    drops: int = 0
+    decisions: list[dict] = field(default_factory=list)
+    spend: dict[int, int] = field(default_factory=dict)
+    copies: dict[int, dict[int, int]] = field(default_factory=dict)   # user -> drop -> копий
+    drop_completion: list[dict] = field(default_factory=list)
+    sold_out_rejections: int = 0
+    wall_sec: float = 0.0
+    virtual_sec: float = 0.0
+
+    @property
+    def decisions_per_sec(self) -> float:
+        return len(self.decisions) / self.wall_sec if self.wall_sec else 0.0
+
+    def as_dict(self) -> dict:
+        return {
+            "drops": self.drops,
+            "decisions": self.decisions,
+            "spend": self.spend,
+            "copies": self.copies,
+            "drop_completion": self.drop_completion,
+            "sold_out_rejections": self.sold_out_rejections,
+            "wall_sec": self.wall_sec,
+            "virtual_sec": self.virtual_sec,
+            "decisions_per_sec": self.decisions_per_sec,
+        }
+
+
+async def replay(
+    snapshots: list[tuple[float, list[dict]]],
+    fixture: dict,
+    *,
+    latency: float = 0.05,
+    global_rps: float = autobuy.GLOBAL_RPS,
+    per_chat_interval: float = autobuy.PER_CHAT_INTERVAL,
+    baseline: bool = True,
+    workdir: Optional[str] = None,
+) -> ReplayReport:
+    """
+    baseline=True: первый снимок только прогревает кэш каталога (как у живого
+    бота, который уже знает текущие подарки), решения начинаются со второго.
+    """
+    tmp = tempfile.TemporaryDirectory() if workdir is None else None
+    base = workdir or tmp.name
+    clock = VirtualClock(snapshots[0][0] if snapshots else 0.0)
+    try:
+        # кэш правил привязан к rules_version, а он в каждой новой БД снова с нуля
+        rules_engine.reset_cache()
+        autobuy.reset_runtime_state()
+        # метки покупок и суточные бюджеты — по виртуальным часам (ts снимков = unix-сек)
+        db.set_clock(lambda: clock.now)
+        await db.init_db(f"sqlite:///{os.path.join(base, 'replay.db')}")
+        await seed_fixture(fixture)
+
+        limiter = VirtualRateLimiter(clock, global_rps, per_chat_interval)
+        sender = NullSender(clock, limiter, latency)
+        report = ReplayReport()
+        started = time.perf_counter()
+        t0 = clock.now
+
+        for i, (ts, gifts) in enumerate(snapshots):
+            clock.advance_to(ts)
+            for g in gifts:
+                sender.supply[str(g["id"])] = g.get("supply")
+            new_ids, _ = await db.apply_catalog_snapshot(gifts)
+            if baseline and i == 0:
+                continue
+            new_gifts = [g for g in gifts if str(g["id"]) in new_ids]
+            if not new_gifts:
+                continue
+
+            report.drops += 1
+            sender.drop = i
+            detected = clock.now
+            decisions = await rules_engine.plan_purchases(new_gifts)
+            first_sent = len(sender.sent)
+            sent = await autobuy.execute_decisions(None, decisions, sender=sender)
+            records = sender.sent[first_sent:]
+
+            done_at: dict[tuple[int, str], float] = {}
+            for r in records:
+                key = (r.user_id, r.gift_id)
+                done_at[key] = max(done_at.get(key, r.t), r.t)
+            last_done = max((r.t for r in records), default=detected)
+            clock.advance_to(last_done)
+            for d, n in zip(decisions, sent):
+                gid = str(d.gift["id"])
+                report.decisions.append({
+                    "drop": i, "ts": ts, "user_id": d.user_id, "gift_id": gid,
+                    "price": int(d.gift["price"]), "copies": d.copies, "sent": n,
+                    "done_after": (done_at[(d.user_id, gid)] - detected) if n else None,
+                })
+                report.spend[d.user_id] = report.spend.get(d.user_id, 0) + int(d.gift["price"]) * n
+                per_drop = report.copies.setdefault(d.user_id, {})
+                per_drop[i] = per_drop.get(i, 0) + n
+            report.drop_completion.append({
+                "drop": i, "ts": ts, "new_gifts": len(new_gifts), "decisions": len(decisions),
+                "sent": sum(sent),
+                "complete_after": last_done - detected,
+            })
+
+        report.sold_out_rejections = sender.sold_out
+        report.wall_sec = time.perf_counter() - started
+        report.virtual_sec = clock.now - t0
+        return report
+    finally:
+        db.set_clock(None)
+        rules_engine.reset_cache()
+        if tmp is not None:
+            tmp.cleanup()
+
+
+def _print_report(rep: ReplayReport) -> None:
+    print(f"drops: {rep.drops}, decisions: {len(rep.decisions)}, sold-out rejections: {rep.sold_out_rejections}")
+    for d in rep.drop_completion:
+        print(
+            f"  drop #{d['drop']} @ {d['ts']:.1f}s: {d['new_gifts']} new, {d['decisions']} decisions, "
+            f"{d['sent']} sent, complete in {d['complete_after']:.2f}s (virtual)"
+        )
+    print("spend per user:")
+    for uid, stars in sorted(rep.spend.items()):
+        drops = ", ".join(f"#{k}: {v}" for k, v in sorted(rep.copies.get(uid, {}).items()))
+        print(f"  {uid}: {stars} ⭐ (copies per drop {drops})")
+    print(
+        f"virtual time {rep.virtual_sec:.2f}s, wall time {rep.wall_sec:.3f}s, "
+        f"{rep.decisions_per_sec:.0f} decisions/s"
+    )
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Offline autobuy drop replay")
+    ap.add_argument("--snapshots", required=True)
+    ap.add_argument("--fixture", required=True)
+    ap.add_argument("--interval", type=float, default=1.0, help="шаг между дампами в каталоге, сек")
+    ap.add_argument("--latency", type=float, default=0.05, help="время одного sendGift, сек")
+    ap.add_argument("--rps", type=float, default=autobuy.GLOBAL_RPS)
+    ap.add_argument("--no-baseline", action="store_true", help="считать первый снимок дропом")
+    ap.add_argument("--json", help="сохранить полный отчёт в файл")
+    args = ap.parse_args()
+
+    snapshots = load_snapshots(args.snapshots, args.interval)
+    fixture = json.loads(Path(args.fixture).read_text("utf-8"))
+    rep = asyncio.run(replay(
+        snapshots, fixture,
+        latency=args.latency, global_rps=args.rps, baseline=not args.no_baseline,
+    ))
+    _print_report(rep)
+    if args.json:
+        Path(args.json).write_text(json.dumps(rep.as_dict(), ensure_ascii=False, indent=2), "utf-8")
+
+
+if __name__ == "__main__":
+    main()
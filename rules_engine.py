@@ -0,0 +1,214 @@
+"""
+Движок правил автобая.
+
+Все правила всех пользователей компилируются в колоночные массивы NumPy,
+и новый каталог проверяется целиком за несколько векторных проходов:
+матрица «правило × подарок» -> «пользователь × подарок» -> бюджеты.
+Скомпилированные правила и матрица совпадений кэшируются до изменения
+правил (db.rules_version()) или каталога.
+"""
+from dataclasses import dataclass
+from typing import Optional, Sequence
+
+import numpy as np
+
+import db
+
+NO_LIMIT = np.iinfo(np.int64).max
+ANY_GIFT = -1       # правило без привязки к подарку
+OTHER_GIFT = -2     # подарок, на который нет ни одного адресного правила
+
+
+@dataclass
+class CompiledRules:
+    version: int
+    user_ids: np.ndarray        # (U,) int64
+    rule_user: np.ndarray       # (R,) индекс пользователя
+    min_price: np.ndarray       # (R,)
+    max_price: np.ndarray       # (R,)
+    gift_code: np.ndarray       # (R,) ANY_GIFT или код из targets
+    only_limited: np.ndarray    # (R,) bool
+    max_copies: np.ndarray      # (R,)
+    daily_budget: np.ndarray    # (U,) минимальный из правил пользователя
+    drop_budget: np.ndarray     # (U,)
+    targets: dict               # gift_id -> код
+
+    @property
+    def empty(self) -> bool:
+        return self.rule_user.size == 0
+
+
+@dataclass(frozen=True)
+class Decision:
+    user_id: int
+    gift: dict
+    copies: int
+
+    @property
+    def cost(self) -> int:
+        return int(self.gift["price"]) * self.copies
+
+
+def _opt(v) -> int:
+    return NO_LIMIT if v is None else int(v)
+
+
+def compile_rules(rows: Sequence, version: int = 0) -> CompiledRules:
+    """rows — строки db.autobuy_rules() (или словари с теми же ключами)."""
+    user_ids = sorted({int(r["user_id"]) for r in rows})
+    uindex = {u: i for i, u in enumerate(user_ids)}
+    targets: dict[str, int] = {}
+    for r in rows:
+        if r["gift_id"] is not None:
+            targets.setdefault(str(r["gift_id"]), len(targets))
+
+    n = len(rows)
+    rule_user = np.fromiter((uindex[int(r["user_id"])] for r in rows), np.int64, n)
+    daily = np.fromiter((_opt(r["daily_budget"]) for r in rows), np.int64, n)
+    drop = np.fromiter((_opt(r["drop_budget"]) for r in rows), np.int64, n)
+
+    # бюджеты — на пользователя, не на правило: берём самый строгий из заданных
+    # в его правилах (так и объясняют /rule_add и /rules)
+    u_daily = np.full(len(user_ids), NO_LIMIT, np.int64)
+    u_drop = np.full(len(user_ids), NO_LIMIT, np.int64)
+    np.minimum.at(u_daily, rule_user, daily)
+    np.minimum.at(u_drop, rule_user, drop)
+
+    return CompiledRules(
+        version=version,
+        user_ids=np.asarray(user_ids, np.int64),
+        rule_user=rule_user,
+        min_price=np.fromiter((int(r["min_price"]) for r in rows), np.int64, n),
+        max_price=np.fromiter((int(r["max_price"]) for r in rows), np.int64, n),
+        gift_code=np.fromiter(
+            (ANY_GIFT if r["gift_id"] is None else targets[str(r["gift_id"])] for r in rows), np.int64, n
+        ),
+        only_limited=np.fromiter((bool(r["only_limited"]) for r in rows), bool, n),
+        max_copies=np.fromiter((max(1, int(r["max_copies"])) for r in rows), np.int64, n),
+        daily_budget=u_daily,
+        drop_budget=u_drop,
+        targets=targets,
+    )
+
+
+def _catalog_arrays(rules: CompiledRules, gifts: Sequence[dict]):
+    g = len(gifts)
+    price = np.fromiter((int(x["price"]) for x in gifts), np.int64, g)
+    limited = np.fromiter((bool(x.get("limited")) for x in gifts), bool, g)
+    code = np.fromiter((rules.targets.get(str(x["id"]), OTHER_GIFT) for x in gifts), np.int64, g)
+    return price, limited, code
+
+
+def match(rules: CompiledRules, gifts: Sequence[dict]) -> np.ndarray:
+    """Матрица (U, G): сколько копий каждого подарка хочет пользователь (0 = не подходит)."""
+    price, limited, code = _catalog_arrays(rules, gifts)
+    hit = (
+        (rules.min_price[:, None] <= price[None, :])
+        & (price[None, :] <= rules.max_price[:, None])
+        & ((rules.gift_code[:, None] == ANY_GIFT) | (rules.gift_code[:, None] == code[None, :]))
+        & (~rules.only_limited[:, None] | limited[None, :])
+    )
+    copies = np.where(hit, rules.max_copies[:, None], 0)
+    wanted = np.zeros((rules.user_ids.size, len(gifts)), np.int64)
+    np.maximum.at(wanted, rules.rule_user, copies)
+    return wanted
+
+
+def allocate(
+    rules: CompiledRules,
+    gifts: Sequence[dict],
+    wanted: np.ndarray,
+    balances: dict[int, int],
+    spent_today: dict[int, int],
+) -> list[Decision]:
+    """
+    Раскладывает совпадения по бюджетам. Подарки идут в порядке приоритета
+    (лимитные, затем дешёвые); каждому пользователю жадно даём столько копий,
+    сколько влезает в остаток min(баланс, остаток дневного бюджета, бюджет
+    на дроп). Неподъёмный подарок пропускается и не мешает следующим.
+    Цикл — по подаркам (их в дропе единицы), по пользователям — векторно.
+    """
+    if wanted.size == 0:
+        return []
+    price, limited, _ = _catalog_arrays(rules, gifts)
+    order = np.lexsort((price, ~limited))
+
+    bal = np.fromiter((balances.get(int(u), 0) for u in rules.user_ids), np.int64, rules.user_ids.size)
+    spent = np.fromiter((spent_today.get(int(u), 0) for u in rules.user_ids), np.int64, rules.user_ids.size)
+    daily_left = np.where(rules.daily_budget == NO_LIMIT, NO_LIMIT, rules.daily_budget - spent)
+    limit = np.minimum(np.minimum(bal, daily_left), rules.drop_budget)
+
+    w = wanted[:, order]
+    p = price[order]
+    remaining = np.maximum(limit, 0)
+    take = np.zeros_like(w)
+    for j in range(w.shape[1]):
+        if p[j] > 0:
+            take[:, j] = np.minimum(w[:, j], remaining // p[j])
+            remaining -= take[:, j] * p[j]
+        else:
+            take[:, j] = w[:, j]
+
+    ui, gi = np.nonzero(take)
+    return [
+        Decision(int(rules.user_ids[u]), gifts[int(order[g])], int(take[u, g]))
+        for u, g in zip(ui, gi)
+    ]
+
+
+# ========= КЭШ =========
+_compiled: Optional[CompiledRules] = None
+_match_key: Optional[tuple] = None
+_match_val: Optional[np.ndarray] = None
+
+
+def reset_cache() -> None:
+    """Сбрасывает скомпилированные правила и матрицу совпадений (смена БД, реплей)."""
+    global _compiled, _match_key, _match_val
+    _compiled = _match_key = _match_val = None
+
+
+def _catalog_key(gifts: Sequence[dict]) -> tuple:
+    return tuple((str(g["id"]), int(g["price"]), bool(g.get("limited"))) for g in gifts)
+
+
+async def get_compiled() -> CompiledRules:
+    global _compiled
+    # версия — из общей БД: правку мог принять другой инстанс
+    version = await db.rules_version()
+    if _compiled is None or _compiled.version != version:
+        _compiled = compile_rules(await db.autobuy_rules(), version)
+    return _compiled
+
+
+def _subtract_already(rules: CompiledRules, gifts: Sequence[dict], wanted: np.ndarray, already: dict) -> np.ndarray:
+    """Вычитает из матрицы желаний копии, уже отправленные раньше (докупка прерванного дропа)."""
+    wanted = wanted.copy()
+    col = {str(g["id"]): j for j, g in enumerate(gifts)}
+    for (uid, gid), n in already.items():
+        u = int(np.searchsorted(rules.user_ids, uid))
+        j = col.get(str(gid))
+        if j is not None and u < rules.user_ids.size and rules.user_ids[u] == uid:
+            wanted[u, j] = max(0, wanted[u, j] - int(n))
+    return wanted
+
+
+async def plan_purchases(gifts: Sequence[dict], already: Optional[dict] = None) -> list[Decision]:
+    """
+    Решения автобая для списка новых подарков по всем правилам всех пользователей.
+    already — {(user_id, gift_id): копий}, которые уже куплены и не нужны повторно.
+    """
+    global _match_key, _match_val
+    if not gifts:
+        return []
+    rules = await get_compiled()
+    if rules.empty:
+        return []
+    key = (rules.version, _catalog_key(gifts))
+    if key != _match_key:
+        _match_key, _match_val = key, match(rules, gifts)
+    wanted = _subtract_already(rules, gifts, _match_val, already) if already else _match_val
+    if not wanted.any():
+        return []
+    balances = {int(r["user_id"]): int(r["balance"]) for r in await db.autobuy_users_with_rules()}
+    return allocate(rules, gifts, wanted, balances, await db.spent_today())
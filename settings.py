@@ -19,5 +19,29 @@ class Settings:
     STARS_CURRENCY: str = os.getenv("STARS_CURRENCY", "XTR")
     # БД: если не задано — локальный SQLite-файл
     DATABASE_URL: str = os.getenv("DATABASE_URL", "sqlite:///giftbot.db")
+    # Получение апдейтов: polling (по умолчанию) или webhook
+    UPDATES_MODE: str = os.getenv("UPDATES_MODE", "polling")
+    WEBHOOK_URL: str = os.getenv("WEBHOOK_URL", "")          # внешний https://host, без пути
+    WEBHOOK_HOST: str = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+    WEBHOOK_PORT: int = int(os.getenv("WEBHOOK_PORT", "8080"))
+    WEBHOOK_PATH: str = os.getenv("WEBHOOK_PATH", "/tg/webhook")
+    WEBHOOK_SECRET: str = os.getenv("WEBHOOK_SECRET", "")      # обязателен в webhook-режиме
+    WEBHOOK_WORKERS: int = int(os.getenv("WEBHOOK_WORKERS", "8"))
+    # Event loop: asyncio (по умолчанию) или uvloop (нужен pip install uvloop)
+    EVENT_LOOP: str = os.getenv("EVENT_LOOP", "asyncio")
+    # Несколько инстансов на одной БД: watcher работает только у лидера (leader.py)
+    HA_ENABLED: bool = os.getenv("HA_ENABLED", "0") == "1"
+    INSTANCE_ID: str = os.getenv("INSTANCE_ID", "")
+    # Лиз лидера: перехват за ~TTL; продление идёт из отдельного потока (leader._Renewer)
+    LEASE_TTL: float = float(os.getenv("LEASE_TTL", "0.8"))
+    LEASE_RENEW: float = float(os.getenv("LEASE_RENEW", "0.2"))
+    # Источники каталога через запятую: botapi, endpoint (см. sources.py)
+    GIFT_SOURCES: str = os.getenv("GIFT_SOURCES", "botapi")
+    GIFT_ENDPOINT_URL: str = os.getenv("GIFT_ENDPOINT_URL", "")
+    # Сколько дней хранить catalog_journal (0 — не чистить)
+    JOURNAL_RETENTION_DAYS: int = int(os.getenv("JOURNAL_RETENTION_DAYS", "30"))
+    # Снапшот состояния watcher'а для тёплого рестарта, напр. giftbot.state
+    # (пусто — выключено; при INSTANCE_ID к имени добавляется id инстанса)
+    STATE_SNAPSHOT_PATH: str = os.getenv("STATE_SNAPSHOT_PATH", "")
 
 settings = Settings()
@@ -0,0 +1,280 @@
+"""
+Снапшот состояния watcher'а для быстрого тёплого рестарта.
+
+Раз в SAVE_EVERY сек и при штатной остановке в файл пишется то, что живёт
+только в памяти процесса:
+
+* планировщик опроса — базовый интервал и конец турбо-режима;
+* рейт-лимитер — последний глобальный слот и слоты по чатам, которые ещё
+  не истекли (autobuy._GLOBAL_LAST / _PER_CHAT_LAST);
+* flood-gate Bot API (autobuy._FLOOD_UNTIL);
+* незавершённые дропы — подарки, покупки по которым шли в момент записи;
+  после рестарта их докупает autobuy.resume_drops (см. main.start_watcher).
+
+Формат — struct, little-endian, CRC32 в конце; запись атомарная (tmp +
+fsync + os.replace); если состояние не менялось, файл не переписывается
+чаще раза в IDLE_SAVE_EVERY сек. Монотонные дедлайны хранятся как wall-clock и при
+восстановлении переводятся обратно, поэтому рестарт посреди дропа сразу
+продолжает турбо-опрос и не превышает лимиты Telegram.
+
+Каталог и правила сюда не попадают: их источник истины — SQLite (другой
+инстанс мог поменять их, пока этот лежал), а правила компилируются заранее,
+до первого опроса, см. main.on_startup.
+"""
+import asyncio
+import logging
+import os
+import struct
+import time
+import zlib
+from dataclasses import dataclass, field
+from typing import Optional
+
+import autobuy
+
+logger = logging.getLogger("giftbot.snapshot")
+
+MAGIC = b"GBS2"
+SAVE_EVERY = 2.0          # сек между фоновыми записями
+IDLE_SAVE_EVERY = 60.0    # без изменений — переписываем не чаще (обновить saved_at)
+MAX_AGE = 3600.0          # старше — считаем протухшим и не восстанавливаем
+RESUME_MAX_AGE = 600.0    # прерванный дроп старше этого не докупаем
+
+_HEADER = struct.Struct("<4sd")       # magic, saved_at (wall)
+_SCHED = struct.Struct("<ddddI")      # base, turbo_until, global_last, flood_until, n_chats
+_CHAT = struct.Struct("<qd")          # chat_id, last slot (wall)
+_COUNT = struct.Struct("<I")
+_STR = struct.Struct("<H")
+_GIFT = struct.Struct("<qBqq")        # price, limited, supply, total (-1 = нет)
+_CRC = struct.Struct("<I")
+
+
+@dataclass
+class State:
+    saved_at: float
+    base_interval: float
+    turbo_until: float          # все моменты — wall-clock (time.time())
+    global_last: float
+    flood_until: float
+    per_chat: dict[int, float] = field(default_factory=dict)
+    pending_drops: list[dict] = field(default_factory=list)
+
+
+@dataclass
+class RestoreInfo:
+    age: float
+    turbo_left: int
+    chats: int
+    pending_drops: list[dict]
+    took_ms: float
+
+
+# ========= СБОР / ПРИМЕНЕНИЕ =========
+def capture() -> State:
+    wall, mono = time.time(), time.monotonic()
+
+    def to_wall(t: float) -> float:
+        return t - mono + wall if t > 0 else 0.0
+
+    # слот чата старше PER_CHAT_INTERVAL уже ни на что не влияет
+    horizon = mono - autobuy.PER_CHAT_INTERVAL
+    return State(
+        saved_at=wall,
+        base_interval=autobuy.POLL_BASE_INTERVAL,
+        turbo_until=to_wall(autobuy._TURBO_UNTIL),
+        global_last=to_wall(autobuy._GLOBAL_LAST),
+        flood_until=to_wall(autobuy._FLOOD_UNTIL),
+        per_chat={c: to_wall(t) for c, t in list(autobuy._PER_CHAT_LAST.items()) if t > horizon},
+        pending_drops=list(autobuy.PENDING_DROPS.values()),
+    )
+
+
+def apply(state: State) -> None:
+    wall, mono = time.time(), time.monotonic()
+
+    def to_mono(t: float) -> float:
+        # прошедшие моменты превращаются в 0 — «ограничений нет»
+        return t - wall + mono if t > wall else 0.0
+
+    autobuy.set_base_interval(state.base_interval)
+    autobuy._TURBO_UNTIL = max(autobuy._TURBO_UNTIL, to_mono(state.turbo_until))
+    autobuy._GLOBAL_LAST = max(autobuy._GLOBAL_LAST, to_mono(state.global_last))
+    autobuy._FLOOD_UNTIL = max(autobuy._FLOOD_UNTIL, to_mono(state.flood_until))
+    horizon = wall - autobuy.PER_CHAT_INTERVAL
+    for chat_id, t in state.per_chat.items():
+        if t > horizon:
+            mt = t - wall + mono
+            autobuy._PER_CHAT_LAST[chat_id] = max(autobuy._PER_CHAT_LAST.get(chat_id, 0.0), mt)
+
+
+# ========= БИНАРНЫЙ ФОРМАТ =========
+def encode(state: State) -> bytes:
+    parts = [
+        _HEADER.pack(MAGIC, state.saved_at),
+        _SCHED.pack(state.base_interval, state.turbo_until, state.global_last,
+                    state.flood_until, len(state.per_chat)),
+    ]
+    parts.extend(_CHAT.pack(c, t) for c, t in state.per_chat.items())
+    parts.append(_COUNT.pack(len(state.pending_drops)))
+    for g in state.pending_drops:
+        parts.append(_pack_str(str(g["id"])))
+        parts.append(_pack_str(str(g.get("title") or "")))
+        parts.append(_GIFT.pack(
+            int(g.get("price") or 0), bool(g.get("limited")), _opt_int(g.get("supply")), _opt_int(g.get("total"))
+        ))
+    body = b"".join(parts)
+    return body + _CRC.pack(zlib.crc32(body))
+
+
+def _pack_str(v: str) -> bytes:
+    raw = v.encode()[:0xFFFF]
+    return _STR.pack(len(raw)) + raw
+
+
+def _unpack_str(body: bytes, off: int) -> tuple[str, int]:
+    (ln,) = _STR.unpack_from(body, off)
+    off += _STR.size
+    return body[off:off + ln].decode(), off + ln
+
+
+def _opt_int(v) -> int:
+    return -1 if v is None else int(v)
+
+
+def decode(data: bytes) -> State:
+    if len(data) < _HEADER.size + _SCHED.size + _COUNT.size + _CRC.size:
+        raise ValueError("snapshot too short")
+    body, (crc,) = data[:-_CRC.size], _CRC.unpack(data[-_CRC.size:])
+    if zlib.crc32(body) != crc:
+        raise ValueError("snapshot checksum mismatch")
+    magic, saved_at = _HEADER.unpack_from(body, 0)
+    if magic != MAGIC:
+        raise ValueError(f"unknown snapshot format {magic!r}")
+    off = _HEADER.size
+    base, turbo, glob, flood, n_chats = _SCHED.unpack_from(body, off)
+    off += _SCHED.size
+    per_chat = {}
+    for chat_id, t in _CHAT.iter_unpack(body[off:off + n_chats * _CHAT.size]):
+        per_chat[chat_id] = t
+    off += n_chats * _CHAT.size
+    (n_pending,) = _COUNT.unpack_from(body, off)
+    off += _COUNT.size
+    pending = []
+    for _ in range(n_pending):
+        gid, off = _unpack_str(body, off)
+        title, off = _unpack_str(body, off)
+        price, limited, supply, total = _GIFT.unpack_from(body, off)
+        off += _GIFT.size
+        pending.append({
+            "id": gid, "title": title, "price": price, "limited": bool(limited),
+            "supply": None if supply < 0 else supply, "total": None if total < 0 else total,
+        })
+    return State(saved_at, base, turbo, glob, flood, per_chat, pending)
+
+
+# ========= ФАЙЛ =========
+def _write_atomic(path: str, data: bytes) -> None:
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def restore(path: str, max_age: float = MAX_AGE) -> Optional[RestoreInfo]:
+    """Применяет снапшот из файла. None — файла нет, он битый или протух."""
+    t0 = time.perf_counter()
+    try:
+        with open(path, "rb") as f:
+            state = decode(f.read())
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, struct.error, UnicodeDecodeError) as e:
+        logger.warning("state snapshot %s ignored: %s", path, e)
+        return None
+    age = time.time() - state.saved_at
+    if age > max_age:
+        logger.info("state snapshot %s is %.0fs old, ignored", path, age)
+        return None
+    apply(state)
+    return RestoreInfo(
+        age=age,
+        turbo_left=autobuy.turbo_remaining(),
+        chats=len(state.per_chat),
+        pending_drops=state.pending_drops,
+        took_ms=(time.perf_counter() - t0) * 1000,
+    )
+
+
+# ========= ФОНОВАЯ ЗАПИСЬ =========
+class Snapshotter:
+    def __init__(self, every: float = SAVE_EVERY):
+        self.every = every
+        self.path = ""
+        self.saves = 0
+        self.last_size = 0
+        self.last_saved_at: Optional[float] = None     # monotonic
+        self.restored: Optional[RestoreInfo] = None
+        self._last_key: Optional[tuple] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def take_pending(self) -> list[dict]:
+        """Прерванные дропы из восстановленного снапшота — отдаются один раз."""
+        r = self.restored
+        if r is None or not r.pending_drops:
+            return []
+        pending, r.pending_drops = r.pending_drops, []
+        if r.age > RESUME_MAX_AGE:
+            logger.warning("interrupted drop %s is %.0fs old, not resumed", [g["id"] for g in pending], r.age)
+            return []
+        return pending
+
+    async def save_now(self, force: bool = False) -> None:
+        if not self.path:
+            return
+        # сравниваем исходные monotonic-значения: любая отправка двигает _GLOBAL_LAST
+        key = (
+            autobuy.POLL_BASE_INTERVAL, autobuy._TURBO_UNTIL, autobuy._GLOBAL_LAST,
+            autobuy._FLOOD_UNTIL, tuple(autobuy.PENDING_DROPS),
+        )
+        idle = self.last_saved_at is not None and time.monotonic() - self.last_saved_at < IDLE_SAVE_EVERY
+        if not force and key == self._last_key and idle:
+            return
+        data = encode(capture())
+        # fsync не должен держать event loop
+        await asyncio.to_thread(_write_atomic, self.path, data)
+        self._last_key = key
+        self.saves += 1
+        self.last_size = len(data)
+        self.last_saved_at = time.monotonic()
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.every)
+            try:
+                await self.save_now()
+            except Exception as e:
+                logger.warning("state snapshot save failed: %s", e)
+
+    def start(self, path: str) -> None:
+        self.path = path
+        if path and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Останавливает фоновую запись и пишет финальный снапшот."""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        try:
+            await self.save_now(force=True)
+        except Exception as e:
+            logger.warning("final state snapshot failed: %s", e)
+
+
+snapshotter = Snapshotter()
@@ -0,0 +1,230 @@
+"""
+Несколько источников каталога подарков с fan-in «кто первый».
+
+GiftSource — общий интерфейс: fetch() отдаёт список подарков в общей модели
+(как autobuy.normalize_gifts: id, title, price, limited, supply, total) или
+None, если с прошлого раза ничего не изменилось. Пуш-источник может
+переопределить run() целиком.
+
+MultiSourceDetector опрашивает все источники параллельно, дедуплицирует по
+gift id и запускает покупки на первом же источнике, увидевшем новый подарок.
+Для каждого источника копится отставание от победителя (lead time).
+"""
+import abc
+import asyncio
+import logging
+import random
+import time
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import aiohttp
+
+import autobuy
+import db
+from gift_monitor import GiftMonitor
+from settings import settings
+
+logger = logging.getLogger("giftbot.sources")
+
+# сколько помним время первого появления подарка для подсчёта отставаний
+LEAD_WINDOW_SEC = 600
+
+
+class GiftSource(abc.ABC):
+    name = "source"
+    # полный ли это каталог (тогда по нему ведём catalog_journal)
+    full_catalog = False
+
+    def interval(self) -> float:
+        return 1.0
+
+    @abc.abstractmethod
+    async def fetch(self) -> Optional[List[Dict]]:
+        ...
+
+    async def run(self, emit: Callable[["GiftSource", List[Dict]], Awaitable[None]], stop: asyncio.Event) -> None:
+        while not stop.is_set():
+            try:
+                gifts = await self.fetch()
+                if gifts:
+                    await emit(self, gifts)
+            except Exception as e:
+                logger.warning("%s: fetch failed: %s", self.name, e)
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=self.interval())
+            except asyncio.TimeoutError:
+                pass
+
+    async def close(self) -> None:
+        return None
+
+
+class BotApiSource(GiftSource):
+    """getAvailableGifts через Bot API (autobuy), интервал — с учётом турбо."""
+    name = "botapi"
+    full_catalog = True
+
+    def interval(self) -> float:
+        return autobuy.current_poll_interval() + random.uniform(0, 0.2)
+
+    async def fetch(self) -> Optional[List[Dict]]:
+        if settings.HA_ENABLED:
+            await autobuy.sync_poll_settings()
+        return await autobuy.fetch_available_gifts()
+
+
+class EndpointSource(GiftSource):
+    """Сторонний монитор с ETag (gift_monitor.GiftMonitor)."""
+    name = "endpoint"
+
+    def __init__(self, url: str, interval: tuple[float, float] = (0.5, 1.2)):
+        self._session = aiohttp.ClientSession()
+        self.monitor = GiftMonitor(self._session, url)
+        self._interval = interval
+
+    def interval(self) -> float:
+        return random.uniform(*self._interval)
+
+    async def fetch(self) -> Optional[List[Dict]]:
+        data = await self.monitor.fetch()
+        if not data:
+            return None
+        # только записи с настоящим id: slug не совпадёт с id из Bot API и дал бы «новый» подарок
+        items = [it for it in data.get("gifts") or data.get("items") or [] if it.get("id") or it.get("gift_id")]
+        return [
+            {
+                "id": str(g["gift_id"]),
+                "title": "Gift",
+                "price": int(g["price"] or 0),
+                "limited": bool(g["is_limited"]),
+                "supply": g["remaining_count"],
+                "total": g["total_count"],
+            }
+            for g in self.monitor.parse_limited(items)
+        ]
+
+    async def close(self) -> None:
+        await self._session.close()
+
+
+def build_sources(names: List[str], endpoint_url: str = "") -> List[GiftSource]:
+    out: List[GiftSource] = []
+    for n in names:
+        if n == "botapi":
+            out.append(BotApiSource())
+        elif n == "endpoint":
+            if not endpoint_url:
+                raise RuntimeError("GIFT_SOURCES=endpoint requires GIFT_ENDPOINT_URL")
+            out.append(EndpointSource(endpoint_url))
+        else:
+            raise RuntimeError(f"Unknown gift source: {n}")
+    return out
+
+
+@dataclass
+class SourceStats:
+    reports: int = 0        # сколько новых подарков источник вообще увидел
+    wins: int = 0           # сколько раз был первым
+    lag_total: float = 0.0  # суммарное отставание от первого, сек
+    lag_max: float = 0.0
+
+    @property
+    def avg_lag_ms(self) -> float:
+        late = self.reports - self.wins
+        return self.lag_total / late * 1000 if late else 0.0
+
+
+class MultiSourceDetector:
+    def __init__(self, sources: List[GiftSource], on_new: Callable[[List[Dict]], Awaitable[None]]):
+        self.sources = sources
+        self.on_new = on_new
+        self.known: set[str] = set()
+        self.first_seen: Dict[str, tuple[str, float]] = {}      # gift_id -> (источник, monotonic)
+        self.reported: Dict[str, set[str]] = {}                 # gift_id -> источники, уже отчитавшиеся
+        self.stats: Dict[str, SourceStats] = {s.name: SourceStats() for s in sources}
+        self._lock = asyncio.Lock()
+        self._handlers: set[asyncio.Task] = set()
+        # источник -> id из его первого ответа: этому источнику они не «новые»
+        self._baseline: Dict[str, set[str]] = {}
+        self._seeded = False                # known взят из непустого gifts_cache
+
+    def _record_lead(self, source: str, gid: str, now: float) -> None:
+        first = self.first_seen.get(gid)
+        if first is None or source in self.reported.setdefault(gid, set()):
+            return
+        self.reported[gid].add(source)
+        st = self.stats.setdefault(source, SourceStats())
+        st.reports += 1
+        if first[0] == source:
+            st.wins += 1
+        else:
+            lag = now - first[1]
+            st.lag_total += lag
+            st.lag_max = max(st.lag_max, lag)
+
+    def _gc(self, now: float) -> None:
+        for gid in [g for g, (_, t) in self.first_seen.items() if now - t > LEAD_WINDOW_SEC]:
+            self.first_seen.pop(gid, None)
+            self.reported.pop(gid, None)
+
+    async def _emit(self, source: GiftSource, gifts: List[Dict]) -> None:
+        now = time.monotonic()
+        autobuy.LAST_WATCHER_TICK = now
+        if source.full_catalog:
+            # журнал каталога ведём по полному источнику; newness решаем сами
+            await db.apply_catalog_snapshot(gifts)
+            await autobuy.maybe_prune_journal()
+
+        async with self._lock:
+            if source.name not in self._baseline:
+                # полный каталог сверяется с gifts_cache; у остальных первый ответ —
+                # точка отсчёта (как replay(baseline=True)), иначе всё, чего нет в
+                # кэше, сошло бы за новинку. В общий known не пишем: настоящий новый
+                # подарок из этого ответа ещё может прийти первым из другого источника
+                if source.full_catalog and self._seeded:
+                    self._baseline[source.name] = set()
+                else:
+                    self._baseline[source.name] = {str(g["id"]) for g in gifts}
+                    logger.info("%s: baseline of %d gifts", source.name, len(gifts))
+                    return
+            base = self._baseline[source.name]
+            fresh = []
+            for g in gifts:
+                gid = str(g["id"])
+                if gid not in self.known and gid not in base:
+                    self.known.add(gid)
+                    self.first_seen[gid] = (source.name, now)
+                    fresh.append(g)
+                self._record_lead(source.name, gid, now)
+            self._gc(now)
+
+        if fresh:
+            logger.info("%s reported new gifts first: %s", source.name, ", ".join(str(g["id"]) for g in fresh))
+            if not source.full_catalog:
+                # чтобы после рестарта не купить их ещё раз; появление — в журнал,
+                # полный опрос его уже не запишет
+                await db.upsert_gifts_cache(fresh)
+            # покупки не должны тормозить опрос остальных источников
+            t = asyncio.create_task(self.on_new(fresh))
+            self._handlers.add(t)
+            t.add_done_callback(self._handlers.discard)
+
+    async def run(self, stop: asyncio.Event) -> None:
+        self.known = await db.known_gift_ids()
+        self._seeded = bool(self.known)
+        try:
+            await asyncio.gather(*(s.run(self._emit, stop) for s in self.sources))
+        finally:
+            autobuy.LAST_WATCHER_TICK = None
+            if self._handlers:
+                await asyncio.gather(*self._handlers, return_exceptions=True)
+            for s in self.sources:
+                await s.close()
+
+    def stats_lines(self) -> List[str]:
+        return [
+            f"{name}: первым {st.wins}/{st.reports}, отставание ср. {st.avg_lag_ms:.0f} мс, "
+            f"макс {st.lag_max * 1000:.0f} мс"
+            for name, st in self.stats.items()
+        ]
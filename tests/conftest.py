@@ -0,0 +1,6 @@
+import os
+import sys
+
+# модули бота лежат в корне репозитория; settings требует BOT_TOKEN при импорте
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("BOT_TOKEN", "0:test")
@@ -0,0 +1,63 @@
+import asyncio
+import time
+
+import db
+
+GIFT = {"id": "g1", "title": "Rocket", "price": 100, "limited": True, "supply": 50, "total": 100}
+
+
+def _run(coro):
+    return asyncio.run(coro)
+
+
+async def _leader(holder: str) -> int:
+    token = await db.acquire_lease("watcher", holder, 60)
+    db.set_fence("watcher", token)
+    return token
+
+
+def test_takeover_finds_interrupted_drop(tmp_path):
+    async def go():
+        await db.init_db(f"sqlite:///{tmp_path / 'ha.db'}")
+        try:
+            await _leader("A")
+            await db.start_drops([GIFT])
+            # A упал посреди дропа; B перехватывает лиз после TTL
+            await db.release_lease("watcher", "A")
+            await _leader("B")
+            return await db.unfinished_drops(600)
+        finally:
+            db.set_fence(None)
+
+    assert _run(go()) == [GIFT]
+
+
+def test_fenced_leader_keeps_drop_for_successor(tmp_path):
+    async def go():
+        await db.init_db(f"sqlite:///{tmp_path / 'ha.db'}")
+        try:
+            await _leader("A")
+            await db.start_drops([GIFT])
+            await db.release_lease("watcher", "A")
+            await db.acquire_lease("watcher", "B", 60)
+            # A ещё жив, но лиз уже у B: снять отметку A не может
+            await db.finish_drops(["g1"])
+            kept = await db.unfinished_drops(600)
+            db.set_fence(None)
+            await db.finish_drops(["g1"])
+            return kept, await db.unfinished_drops(600)
+        finally:
+            db.set_fence(None)
+
+    kept, after = _run(go())
+    assert [g["id"] for g in kept] == ["g1"] and after == []
+
+
+def test_stale_drop_is_dropped(tmp_path):
+    async def go():
+        await db.init_db(f"sqlite:///{tmp_path / 'ha.db'}")
+        await db.start_drops([GIFT])
+        time.sleep(0.05)
+        return await db.unfinished_drops(0.01), await db.unfinished_drops(600)
+
+    assert _run(go()) == ([], [])
@@ -0,0 +1,58 @@
+import asyncio
+import sqlite3
+
+import pytest
+
+import db
+import journal
+
+
+def test_needs_two_points():
+    assert journal.sell_through("g", []) is None
+    assert journal.sell_through("g", [(0, 10)]) is None
+
+
+def test_rate_and_eta():
+    # 60 штук за минуту, осталось 40 — до нуля ещё 40 сек
+    st = journal.sell_through("g", [(0, 100), (30_000, 70), (60_000, 40)])
+    assert st.sold == 60
+    assert st.first_supply == 100 and st.last_supply == 40
+    assert st.span_sec == pytest.approx(60.0)
+    assert st.per_min == pytest.approx(60.0)
+    assert st.eta_sec == pytest.approx(40.0)
+
+
+def test_restock_is_not_counted_as_sale():
+    st = journal.sell_through("g", [(0, 10), (60_000, 5), (120_000, 20), (180_000, 15)])
+    assert st.sold == 10
+
+
+def test_no_sales_has_no_eta():
+    st = journal.sell_through("g", [(0, 10), (60_000, 10)])
+    assert st.per_min == 0 and st.eta_sec is None
+    assert journal.format_eta(None) == "∞"
+
+
+def test_format_eta():
+    assert journal.format_eta(45) == "45 сек"
+    assert journal.format_eta(600) == "10 мин"
+    assert journal.format_eta(3 * 3600) == "3.0 ч"
+
+
+
+def test_gift_found_by_endpoint_is_journaled_once(tmp_path):
+    path = tmp_path / "bot.db"
+    gift = {"id": "g1", "title": "Rocket", "price": 100, "supply": 50}
+
+    async def go():
+        await db.init_db(f"sqlite:///{path}")
+        # подарок первым увидел endpoint, следом его же вернул полный опрос Bot API
+        await db.upsert_gifts_cache([gift])
+        return await db.apply_catalog_snapshot([dict(gift, supply=49)])
+
+    new_ids, events = asyncio.run(go())
+    assert new_ids == set()
+    assert [e[2] for e in events] == [db.J_SUPPLY]
+    with sqlite3.connect(path) as conn:
+        rows = conn.execute("SELECT kind, supply FROM catalog_journal ORDER BY kind").fetchall()
+    assert rows == [(db.J_ADDED, 50), (db.J_SUPPLY, 49)]
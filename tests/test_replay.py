@@ -0,0 +1,36 @@
+import asyncio
+
+import replay
+
+
+def _gift(gid: str, price: int = 100) -> dict:
+    return {"id": gid, "title": "", "price": price, "limited": False, "supply": None, "total": None}
+
+
+def _fixture(copies: int, daily_budget=None) -> dict:
+    rule = {"min_price": 0, "max_price": 500, "max_copies": copies, "daily_budget": daily_budget}
+    return {"users": [{"user_id": 1, "balance": 100_000, "rules": [rule]}]}
+
+
+def _sent(rep) -> list[tuple[str, int]]:
+    return [(d["gift_id"], d["sent"]) for d in rep.decisions]
+
+
+def test_second_replay_uses_its_own_rules():
+    snaps = [(0.0, []), (10.0, [_gift("a")])]
+    first = asyncio.run(replay.replay(snaps, _fixture(3)))
+    second = asyncio.run(replay.replay(snaps, _fixture(1)))
+    assert _sent(first) == [("a", 3)]
+    assert _sent(second) == [("a", 1)]
+
+
+def test_daily_budget_follows_virtual_clock():
+    # бюджет — на один подарок в сутки; третий дроп через двое виртуальных суток
+    snaps = [
+        (0.0, []),
+        (10.0, [_gift("x")]),
+        (20.0, [_gift("x"), _gift("y")]),
+        (2 * 86400.0, [_gift("x"), _gift("y"), _gift("z")]),
+    ]
+    rep = asyncio.run(replay.replay(snaps, _fixture(1, daily_budget=100)))
+    assert _sent(rep) == [("x", 1), ("z", 1)]
@@ -0,0 +1,49 @@
+import asyncio
+
+import db
+
+
+def _run(coro):
+    return asyncio.run(coro)
+
+
+async def _setup(tmp_path, balance: int) -> None:
+    await db.init_db(f"sqlite:///{tmp_path / 'bot.db'}")
+    await db.ensure_user(1, None)
+    await db.add_balance(1, balance)
+
+
+def test_reserve_is_capped_by_balance(tmp_path):
+    async def go():
+        await _setup(tmp_path, 250)
+        rid, n = await db.reserve_balance(1, "g", 100, 5)
+        return rid, n, await db.get_balance(1)
+
+    rid, n, left = _run(go())
+    assert rid and n == 2 and left == 50
+
+
+def test_release_refunds_only_unsent_copies(tmp_path):
+    async def go():
+        await _setup(tmp_path, 300)
+        rid, _ = await db.reserve_balance(1, "g", 100, 3)
+        await db.record_purchase(1, "g", 100, rid)
+        refund = await db.release_reservation(rid)
+        again = await db.release_reservation(rid)
+        return refund, again, await db.get_balance(1)
+
+    refund, again, left = _run(go())
+    assert (refund, again, left) == (200, 0, 200)
+
+
+def test_open_reservation_is_refunded_after_crash(tmp_path):
+    async def go():
+        await _setup(tmp_path, 500)
+        rid, _ = await db.reserve_balance(1, "g", 100, 4)
+        await db.record_purchase(1, "g", 100, rid)
+        # процесс упал: release_reservation так и не вызван
+        refund = await db.refund_open_reservations()
+        return refund, await db.refund_open_reservations(), await db.get_balance(1)
+
+    refund, again, left = _run(go())
+    assert (refund, again, left) == (300, 0, 400)
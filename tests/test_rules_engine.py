@@ -0,0 +1,67 @@
+import rules_engine as re_
+
+
+def _rule(user_id, **kw):
+    row = {
+        "user_id": user_id, "gift_id": None, "min_price": 0, "max_price": 10**9,
+        "only_limited": 0, "max_copies": 1, "daily_budget": None, "drop_budget": None,
+    }
+    row.update(kw)
+    return row
+
+
+def _gift(gid, price, limited=False):
+    return {"id": gid, "price": price, "limited": limited}
+
+
+def _plan(rows, gifts, balances, spent=None):
+    rules = re_.compile_rules(rows)
+    wanted = re_.match(rules, gifts)
+    return {(d.user_id, d.gift["id"]): d.copies for d in re_.allocate(rules, gifts, wanted, balances, spent or {})}
+
+
+def test_limited_first_then_cheapest():
+    gifts = [_gift("cheap", 100), _gift("lim", 300, limited=True), _gift("mid", 200)]
+    # хватает только на два подарка: сначала лимитный, потом самый дешёвый
+    assert _plan([_rule(1)], gifts, {1: 400}) == {(1, "lim"): 1, (1, "cheap"): 1}
+
+
+def test_unaffordable_gift_does_not_block_cheaper_ones():
+    gifts = [_gift("big", 5000, limited=True), _gift("small", 100)]
+    assert _plan([_rule(1)], gifts, {1: 1000}) == {(1, "small"): 1}
+
+
+def test_partial_copies_fit_budget():
+    gifts = [_gift("g", 400, limited=True)]
+    assert _plan([_rule(1, max_copies=3)], gifts, {1: 1000}) == {(1, "g"): 2}
+
+
+def test_drop_and_daily_budgets():
+    gifts = [_gift("g", 100)]
+    assert _plan([_rule(1, max_copies=5, drop_budget=250)], gifts, {1: 10**6}) == {(1, "g"): 2}
+    # за сутки уже потрачено 900 из 1000
+    assert _plan([_rule(1, max_copies=5, daily_budget=1000)], gifts, {1: 10**6}, {1: 900}) == {(1, "g"): 1}
+
+
+def test_only_limited():
+    gifts = [_gift("plain", 100), _gift("lim", 100, limited=True)]
+    assert _plan([_rule(1, only_limited=1)], gifts, {1: 1000}) == {(1, "lim"): 1}
+
+
+def test_gift_targeting():
+    gifts = [_gift("a", 100), _gift("b", 100)]
+    rows = [_rule(1, gift_id="b", max_copies=2), _rule(2, gift_id="zzz")]
+    assert _plan(rows, gifts, {1: 1000, 2: 1000}) == {(1, "b"): 2}
+
+
+def test_price_range_and_max_copies_across_rules():
+    gifts = [_gift("a", 50), _gift("b", 500)]
+    rows = [_rule(1, min_price=100, max_price=1000), _rule(1, gift_id="b", max_copies=3)]
+    # на один подарок — максимум копий из подходящих правил
+    assert _plan(rows, gifts, {1: 10**6}) == {(1, "b"): 3}
+
+
+def test_empty_rules():
+    rules = re_.compile_rules([])
+    assert rules.empty
+    assert re_.allocate(rules, [_gift("a", 1)], re_.match(rules, [_gift("a", 1)]), {}, {}) == []
@@ -0,0 +1,62 @@
+import struct
+import zlib
+
+import pytest
+
+import snapshot
+
+
+def _state() -> snapshot.State:
+    return snapshot.State(
+        saved_at=1_700_000_000.5,
+        base_interval=7.5,
+        turbo_until=1_700_000_120.0,
+        global_last=1_700_000_000.25,
+        flood_until=0.0,
+        per_chat={1: 1_700_000_000.0, -100123: 1_699_999_999.75},
+        pending_drops=[
+            {"id": "5170145012310081615", "title": "Ракета 🚀", "price": 250, "limited": True,
+             "supply": 0, "total": 10_000},
+            {"id": "g2", "title": "", "price": 15, "limited": False, "supply": None, "total": None},
+        ],
+    )
+
+
+def test_round_trip():
+    st = _state()
+    assert snapshot.decode(snapshot.encode(st)) == st
+
+
+def test_empty_state_round_trip():
+    st = snapshot.State(1.0, 10.0, 0.0, 0.0, 0.0)
+    assert snapshot.decode(snapshot.encode(st)) == st
+
+
+def test_corrupted_byte_fails_checksum():
+    data = bytearray(snapshot.encode(_state()))
+    data[10] ^= 0xFF
+    with pytest.raises(ValueError, match="checksum"):
+        snapshot.decode(bytes(data))
+
+
+def test_truncated_snapshot_is_rejected():
+    data = snapshot.encode(_state())
+    with pytest.raises(ValueError):
+        snapshot.decode(data[:8])
+    with pytest.raises(ValueError, match="checksum"):
+        snapshot.decode(data[:-3])
+
+
+def test_unknown_magic_is_rejected():
+    body = snapshot.encode(_state())[:-4]
+    body = b"GBS1" + body[4:]
+    data = body + struct.pack("<I", zlib.crc32(body))
+    with pytest.raises(ValueError, match="format"):
+        snapshot.decode(data)
+
+
+def test_restore_ignores_broken_file(tmp_path):
+    path = tmp_path / "bot.state"
+    path.write_bytes(b"garbage" * 10)
+    assert snapshot.restore(str(path)) is None
+    assert snapshot.restore(str(tmp_path / "missing.state")) is None
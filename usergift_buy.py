@@ -3,7 +3,7 @@ import json
 import logging
 import time
 from contextlib import asynccontextmanager
-from typing import Any, Dict, List, Optional
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -12,7 +12,13 @@ import aiohttp
 from telethon import TelegramClient, events
 from telethon.errors import FloodWaitError
 
+from gift_monitor import GiftMonitor
+
 SESSION = "user_session"  # сессия именно аккаунта, не бота
+# пул аккаунтов: SESSIONS=user_session,acc2,acc3 (по умолчанию — один SESSION)
+SESSIONS = [x.strip() for x in os.getenv("SESSIONS", SESSION).split(",") if x.strip()]
+MAX_IN_FLIGHT_PER_ACCOUNT = int(os.getenv("MAX_IN_FLIGHT_PER_ACCOUNT", "2"))
+COPIES_PER_GIFT = int(os.getenv("COPIES_PER_GIFT", "1"))
 
 API_ID = os.getenv("API_ID")
 API_HASH = os.getenv("API_HASH")
@@ -41,70 +47,57 @@ async def aiohttp_session():
         yield s
 
 
-class GiftMonitor:
-    def __init__(self, session: aiohttp.ClientSession):
-        self.session = session
-        self.etag = None
+async def get_stars_balance(client: TelegramClient) -> Optional[int]:
+    # TODO: подставь свою проверку баланса Stars из твоего payments.py
+    # None = баланс неизвестен, покупки не ограничиваем
+    return None
 
-    async def fetch(self) -> Optional[Dict[str, Any]]:
-        headers = {}
-        if self.etag:
-            headers["If-None-Match"] = self.etag
-        try:
-            async with self.session.get(GIFTS_ENDPOINT, headers=headers, timeout=5) as r:
-                if r.status == 304:
-                    return None
-                if et := r.headers.get("ETag"):
-                    self.etag = et
-                if r.status == 401:
-                    # Не фатально для мониторинга
-                    data = await r.text()
-                    logger.debug("Unauthorized on gifts endpoint: %s", data)
-                    return {}
-                r.raise_for_status()
-                return await r.json()
-        except Exception as e:
-            logger.warning("fetch gifts error: %s", e)
-            return {}
-
-    @staticmethod
-    def parse_limited(items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-        out = []
-        for it in items:
-            # Безопасный парсинг
-            gift_id = it.get("id") or it.get("gift_id") or it.get("slug")
-            total = it.get("total_count")
-            remain = it.get("remaining_count")
-            is_limited = it.get("is_limited")
-            price = it.get("price_stars") or it.get("price")  # в звёздах
-
-            limited_flag = False
-            if is_limited is True:
-                limited_flag = True
-            elif total is not None:
-                limited_flag = True
-            elif remain is not None:
-                limited_flag = True
-
-            out.append({
-                "gift_id": gift_id,
-                "price": price,
-                "total_count": total,
-                "remaining_count": remain,
-                "is_limited": limited_flag
-            })
-        return out
+
+async def purchase_gift(client: TelegramClient, gift_id: str, price: int) -> None:
+    """Покупка подарка со стороны ЮЗЕР-АККА. Бросает исключение при неудаче."""
+    # === ВАРИАНТ А: прямые вызовы (заглушки) ===
+    # tx = await start_gift_purchase(client, gift_id)
+    # await confirm_stars_transaction(client, tx.id)
+
+    # === ВАРИАНТ B: через дееплинк бота подарков (заглушка) ===
+    # link = f"https://t.me/gifts?start=gift_{gift_id}"
+    # await open_deeplink_and_confirm(client, link)
+    return None
 
 
 class Buyer:
-    def __init__(self, client: TelegramClient):
+    def __init__(
+        self,
+        client: TelegramClient,
+        name: str = SESSION,
+        max_in_flight: int = MAX_IN_FLIGHT_PER_ACCOUNT,
+        purchase: Optional[Callable[[str, int], Awaitable[None]]] = None,
+    ):
         self.client = client
+        self.name = name
         self.last_buys: Dict[str, int] = {}  # gift_id -> ts
+        # состояние аккаунта для пула
+        self.stars: Optional[int] = None        # известный баланс, None = неизвестен
+        self.flood_until = 0.0                  # monotonic; до этого момента аккаунт в кулдауне
+        self.in_flight = 0                      # ведёт BuyerPool
+        self.max_in_flight = max(1, max_in_flight)
+        self._purchase = purchase or (lambda gift_id, price: purchase_gift(client, gift_id, price))
+
+    def flood_remaining(self) -> float:
+        return max(0.0, self.flood_until - time.monotonic())
+
+    def available(self, price: int = 0) -> bool:
+        return (
+            self.flood_remaining() == 0
+            and self.in_flight < self.max_in_flight
+            and (self.stars is None or self.stars >= price)
+        )
+
+    async def refresh_balance(self) -> None:
+        self.stars = await get_stars_balance(self.client)
 
     async def ensure_stars_balance(self, need: int) -> bool:
-        # TODO: подставь свою проверку баланса Stars из твоего payments.py
-        # return await get_stars_balance(self.client) >= need
-        return True
+        return self.stars is None or self.stars >= need
 
     async def already_bought_recently(self, gift_id: str, cooldown_sec=60) -> bool:
         ts = self.last_buys.get(gift_id)
@@ -113,35 +106,156 @@ class Buyer:
     async def buy_gift(self, gift_id: str, price: int) -> bool:
         """
         Пытается купить подарок gift_id со стороны ЮЗЕР-АККА.
-        Верни True при успехе.
+        Верни True при успехе. FLOOD_WAIT не спит, а ставит аккаунт в кулдаун —
+        пул в это время отдаёт покупки другим аккаунтам.
         """
         try:
             ok = await self.ensure_stars_balance(price or 0)
             if not ok:
-                logger.warning("Not enough stars for %s", gift_id)
+                logger.warning("[%s] Not enough stars for %s", self.name, gift_id)
                 return False
 
-            # === ВАРИАНТ А: прямые вызовы (заглушки) ===
-            # tx = await start_gift_purchase(self.client, gift_id)
-            # await confirm_stars_transaction(self.client, tx.id)
-
-            # === ВАРИАНТ B: через дееплинк бота подарков (заглушка) ===
-            # link = f"https://t.me/gifts?start=gift_{gift_id}"
-            # await open_deeplink_and_confirm(self.client, link)
+            await self._purchase(gift_id, price)
 
             # Пометь как купленный
             self.last_buys[gift_id] = time.time()
+            if self.stars is not None:
+                self.stars -= price or 0
             return True
 
         except FloodWaitError as e:
-            logger.error("FLOOD_WAIT %s", e)
-            await asyncio.sleep(e.seconds + 1)
+            logger.error("[%s] FLOOD_WAIT %s", self.name, e)
+            self.flood_until = time.monotonic() + e.seconds + 1
             return False
         except Exception as e:
-            logger.exception("Unexpected buy error: %s", e)
+            logger.exception("[%s] Unexpected buy error: %s", self.name, e)
             return False
 
 
+class BuyerPool:
+    """
+    Пул юзер-аккаунтов. Каждую покупку отдаём наименее загруженному доступному
+    аккаунту (не во флуд-кулдауне, есть свободный слот, хватает звёзд).
+    Аккаунт, словивший FLOOD_WAIT, сам выпадает из ротации до конца кулдауна.
+    """
+
+    def __init__(self, buyers: List[Buyer]):
+        self.buyers = buyers
+        self._changed = asyncio.Condition()
+
+    def pick(self, price: int = 0, exclude: Iterable[Buyer] = ()) -> Optional[Buyer]:
+        skip = set(map(id, exclude))
+        ready = [b for b in self.buyers if id(b) not in skip and b.available(price)]
+        if not ready:
+            return None
+        return min(ready, key=lambda b: (b.in_flight / b.max_in_flight, -(b.stars or 0)))
+
+    def next_ready_in(self) -> Optional[float]:
+        """Через сколько секунд освободится хоть один аккаунт из флуд-кулдауна (None — таких нет)."""
+        waits = [w for w in (b.flood_remaining() for b in self.buyers) if w > 0]
+        return min(waits) if waits else None
+
+    async def already_bought_recently(self, gift_id: str, cooldown_sec=60) -> bool:
+        for b in self.buyers:
+            if await b.already_bought_recently(gift_id, cooldown_sec):
+                return True
+        return False
+
+    async def _acquire(self, price: int, exclude: Iterable[Buyer] = (), timeout: float = 5.0) -> Optional[Buyer]:
+        # ждём освобождения слота (_release будит) или конца ближайшего флуд-кулдауна,
+        # но не дольше timeout (кулдауны могут быть долгими)
+        deadline = time.monotonic() + timeout
+        async with self._changed:
+            while True:
+                b = self.pick(price, exclude)
+                if b is not None:
+                    b.in_flight += 1   # резерв слота до входа в buy_gift
+                    return b
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    return None
+                flood = self.next_ready_in()
+                try:
+                    await asyncio.wait_for(self._changed.wait(), timeout=min(left, flood) if flood else left)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _release(self, b: Buyer) -> None:
+        b.in_flight -= 1
+        async with self._changed:
+            self._changed.notify_all()
+
+    async def buy(
+        self, gift_id: str, price: int, retries: int = 2, stop: Optional[asyncio.Event] = None
+    ) -> Optional[Buyer]:
+        """
+        Одна копия: при FLOOD_WAIT повторяем на другом аккаунте. Возвращает купивший аккаунт.
+        stop проверяется после получения слота — пока ждали, покупку могли отменить.
+        """
+        tried: list[Buyer] = []
+        for _ in range(retries + 1):
+            b = await self._acquire(price, exclude=tried)
+            if b is None:
+                return None
+            if stop is not None and stop.is_set():
+                await self._release(b)
+                return None
+            try:
+                ok = await b.buy_gift(gift_id, price)
+            finally:
+                await self._release(b)
+            if ok:
+                return b
+            if b.flood_remaining() == 0:
+                return None   # не флуд — другой аккаунт тоже не поможет
+            tried.append(b)
+        return None
+
+    async def race(self, gift_id: str, price: int, attempts: int = 3) -> Optional[Buyer]:
+        """Параллельные попытки на разных аккаунтах, кто первый купил — тот и выиграл."""
+        tasks = [asyncio.create_task(self.buy(gift_id, price, retries=0)) for _ in range(attempts)]
+        winner = None
+        try:
+            for fut in asyncio.as_completed(tasks):
+                winner = await fut
+                if winner is not None:
+                    break
+        finally:
+            for t in tasks:
+                t.cancel()
+        return winner
+
+    async def buy_copies(self, gift_id: str, price: int, copies: int) -> int:
+        """
+        N копий параллельно по аккаунтам; после первой неудачи новые покупки не
+        начинаем — копии, ещё ждущие слота, видят stop уже после _acquire.
+        Уже отправленные запросы (не больше суммарной ёмкости пула) дорабатывают.
+        """
+        stop = asyncio.Event()
+        got = 0
+
+        async def one():
+            nonlocal got
+            if await self.buy(gift_id, price, stop=stop) is not None:
+                got += 1
+            else:
+                stop.set()
+
+        await asyncio.gather(*(one() for _ in range(copies)))
+        return got
+
+    def stats(self) -> List[Dict[str, Any]]:
+        return [
+            {
+                "name": b.name,
+                "in_flight": b.in_flight,
+                "flood_wait": round(b.flood_remaining(), 1),
+                "stars": b.stars,
+            }
+            for b in self.buyers
+        ]
+
+
 async def notify_channel(client: TelegramClient, text: str, extra_json: Optional[dict] = None):
     msg = text
     if extra_json:
@@ -151,16 +265,24 @@ async def notify_channel(client: TelegramClient, text: str, extra_json: Optional
 
 async def main():
     async with aiohttp_session() as http:
-        monitor = GiftMonitor(http)
-
-        client = TelegramClient(SESSION, API_ID, API_HASH)
-        await client.connect()
-        if not await client.is_user_authorized():
-            print("Нужна авторизация: отправь код/пароль в консоль при первом запуске.")
-            await client.send_code_request("+10000000000")  # <-- поставь свой номер или авторизуйся заранее
+        monitor = GiftMonitor(http, GIFTS_ENDPOINT)
+
+        buyers = []
+        for session in SESSIONS:
+            c = TelegramClient(session, API_ID, API_HASH)
+            await c.connect()
+            if not await c.is_user_authorized():
+                print(f"[{session}] Нужна авторизация: отправь код/пароль в консоль при первом запуске.")
+                await c.send_code_request("+10000000000")  # <-- поставь свой номер или авторизуйся заранее
+                continue
+            b = Buyer(c, session, MAX_IN_FLIGHT_PER_ACCOUNT)
+            await b.refresh_balance()
+            buyers.append(b)
+        if not buyers:
             return
 
-        buyer = Buyer(client)
+        pool = BuyerPool(buyers)
+        client = buyers[0].client  # через первый аккаунт шлём уведомления в канал
 
         idle_hits = 0
         while True:
@@ -189,28 +311,28 @@ async def main():
                     return (0 if (g["gift_id"] in DESIRED_GIFTS) else 1, g["price"] or 10**9)
                 candidates.sort(key=prio)
 
-                # Берем топ‑1 и делаем 2–3 параллельные попытки покупки
+                # Берем топ‑1: одна копия — 2–3 параллельные попытки на разных аккаунтах,
+                # несколько копий — раскидываем по пулу
                 target = candidates[0]
                 gift_id = str(target["gift_id"])
                 price = int(target["price"] or 0)
 
-                if not await buyer.already_bought_recently(gift_id):
+                if not await pool.already_bought_recently(gift_id):
                     await notify_channel(client, f"Пробуем купить: <b>{gift_id}</b>", target)
-                    attempts = [
-                        buyer.buy_gift(gift_id, price),
-                        buyer.buy_gift(gift_id, price),
-                        buyer.buy_gift(gift_id, price),
-                    ]
-                    done, pending = await asyncio.wait(attempts, return_when=asyncio.FIRST_COMPLETED)
-                    success = any(t.result() for t in done if not t.cancelled())
-                    # Отменим оставшиеся
-                    for p in pending:
-                        p.cancel()
-
-                    if success:
-                        await notify_channel(client, f"✅ Куплено: <b>{gift_id}</b>", target)
+                    if COPIES_PER_GIFT > 1:
+                        got = await pool.buy_copies(gift_id, price, COPIES_PER_GIFT)
+                    else:
+                        got = 1 if await pool.race(gift_id, price, attempts=3) else 0
+
+                    if got:
+                        await notify_channel(client, f"✅ Куплено: <b>{gift_id}</b> ×{got}", target)
                     else:
                         await notify_channel(client, f"❌ Не удалось: <b>{gift_id}</b>", target)
+                    if not any(b.available(price) for b in pool.buyers):
+                        logger.warning(
+                            "All accounts busy/flood-waited (next ready in %s s): %s",
+                            pool.next_ready_in(), pool.stats(),
+                        )
                 else:
                     logger.info("Skip %s: already attempted very recently", gift_id)
 
@@ -0,0 +1,141 @@
+import asyncio
+import hmac
+import logging
+import time
+from typing import Optional
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+
+logger = logging.getLogger("giftbot.webhook")
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class WebhookHandler:
+    """
+    Приём апдейтов по вебхуку: проверка секрета, очередь фиксированного
+    размера и N воркеров, которые скармливают апдейты в диспетчер.
+    Телеграму отвечаем сразу (200), обработка идёт в фоне.
+    """
+
+    def __init__(
+        self,
+        dispatcher: Dispatcher,
+        bot: Bot,
+        secret: str,
+        workers: int = 8,
+        queue_size: int = 1000,
+    ):
+        if not secret:
+            # без секрета любой, кто узнал URL, может прислать поддельный successful_payment
+            raise ValueError("webhook secret is required")
+        self.dispatcher = dispatcher
+        self.bot = bot
+        self.secret = secret
+        self.workers = max(1, int(workers))
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max(1, int(queue_size)))
+        self._tasks: list[asyncio.Task] = []
+        # статистика для /speed_status и бенчмарка
+        self.received = 0
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.busy_total = 0.0   # суммарное время обработки, сек
+        self.wait_total = 0.0   # суммарное время в очереди, сек
+
+    async def handle(self, request: web.Request) -> web.Response:
+        token = request.headers.get(SECRET_HEADER, "")
+        if not hmac.compare_digest(token, self.secret):
+            self.rejected += 1
+            return web.Response(status=401)
+        try:
+            data = await request.json()
+        except Exception:
+            return web.Response(status=400)
+        self.received += 1
+        # если очередь заполнена — ждём (backpressure), Телеграм подождёт ответа
+        await self.queue.put((time.perf_counter(), data))
+        return web.Response(status=200)
+
+    async def _worker(self) -> None:
+        while True:
+            enqueued_at, data = await self.queue.get()
+            started = time.perf_counter()
+            self.wait_total += started - enqueued_at
+            try:
+                await self.dispatcher.feed_raw_update(self.bot, data)
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                logger.warning("webhook update failed: %s", e)
+            finally:
+                self.busy_total += time.perf_counter() - started
+                self.queue.task_done()
+
+    async def start(self, *_) -> None:
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, *_) -> None:
+        # дорабатываем то, что уже приняли, потом гасим воркеров
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout=5)
+        except asyncio.TimeoutError:
+            logger.warning("webhook queue not drained: %d left", self.queue.qsize())
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def stats(self) -> dict:
+        done = self.processed + self.failed
+        return {
+            "received": self.received,
+            "processed": self.processed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "queued": self.queue.qsize(),
+            "workers": self.workers,
+            "avg_wait_ms": (self.wait_total / done * 1000) if done else 0.0,
+            "avg_handle_ms": (self.busy_total / done * 1000) if done else 0.0,
+        }
+
+
+def build_app(handler: WebhookHandler, path: str) -> web.Application:
+    app = web.Application()
+    app.router.add_post(path, handler.handle)
+    app.on_startup.append(handler.start)
+    app.on_shutdown.append(handler.stop)
+    return app
+
+
+async def serve(handler: WebhookHandler, host: str, port: int, path: str) -> web.AppRunner:
+    runner = web.AppRunner(build_app(handler, path))
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    logger.info("Webhook server listening on %s:%s%s", host, port, path)
+    return runner
+
+
+async def run_webhook(
+    handler: WebhookHandler,
+    *,
+    url: str,
+    host: str,
+    port: int,
+    path: str,
+    stop_event: Optional[asyncio.Event] = None,
+) -> None:
+    """Поднимает aiohttp-сервер, регистрирует вебхук и ждёт остановки."""
+    runner = await serve(handler, host, port, path)
+    try:
+        await handler.bot.set_webhook(
+            url.rstrip("/") + path,
+            secret_token=handler.secret,
+            allowed_updates=handler.dispatcher.resolve_used_update_types(),
+        )
+        await (stop_event or asyncio.Event()).wait()
+    finally:
+        await runner.cleanup()
@@ -0,0 +1,108 @@
+"""
+Локальный стенд для вебхука: поднимает WebhookHandler на 127.0.0.1 и
+шлёт в него синтетические апдейты. Сеть до Telegram не нужна — хендлер
+ничего не отвечает, только меряет время.
+
+    python webhook_bench.py --updates 5000 --concurrency 50 --workers 8
+"""
+import argparse
+import asyncio
+import time
+
+import aiohttp
+from aiogram import Bot, Dispatcher, types
+
+from webhook import SECRET_HEADER, WebhookHandler, serve
+
+HOST = "127.0.0.1"
+PATH = "/bench"
+SECRET = "bench-secret"
+
+
+def _percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    idx = min(len(values) - 1, int(round(q * (len(values) - 1))))
+    return values[idx]
+
+
+def _synthetic_update(update_id: int) -> dict:
+    # время отправки кладём прямо в текст — хендлер посчитает end-to-end
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": 1000 + update_id % 100, "type": "private"},
+            "from": {"id": 1000 + update_id % 100, "is_bot": False, "first_name": "bench"},
+            "text": f"bench:{time.perf_counter()}",
+        },
+    }
+
+
+async def bench(updates: int, concurrency: int, workers: int, port: int, handler_delay: float) -> dict:
+    dp = Dispatcher()
+    e2e: list[float] = []
+    done = asyncio.Event()
+
+    @dp.message()
+    async def _on_message(m: types.Message):
+        if handler_delay:
+            await asyncio.sleep(handler_delay)
+        sent = float(m.text.split(":", 1)[1])
+        e2e.append(time.perf_counter() - sent)
+        if len(e2e) >= updates:
+            done.set()
+
+    bot = Bot(token="42:BENCH")
+    handler = WebhookHandler(dp, bot, secret=SECRET, workers=workers, queue_size=updates)
+    runner = await serve(handler, HOST, port, PATH)
+    url = f"http://{HOST}:{port}{PATH}"
+    post_latency: list[float] = []
+    sem = asyncio.Semaphore(concurrency)
+
+    async def _post(http: aiohttp.ClientSession, i: int):
+        async with sem:
+            t0 = time.perf_counter()
+            async with http.post(url, json=_synthetic_update(i), headers={SECRET_HEADER: SECRET}) as r:
+                await r.read()
+            post_latency.append(time.perf_counter() - t0)
+
+    try:
+        started = time.perf_counter()
+        async with aiohttp.ClientSession() as http:
+            await asyncio.gather(*(_post(http, i) for i in range(1, updates + 1)))
+        await asyncio.wait_for(done.wait(), timeout=60)
+        elapsed = time.perf_counter() - started
+    finally:
+        await runner.cleanup()
+        await bot.session.close()
+
+    return {
+        "updates": updates,
+        "elapsed_s": elapsed,
+        "updates_per_s": updates / elapsed if elapsed else 0.0,
+        "post_p50_ms": _percentile(post_latency, 0.50) * 1000,
+        "post_p99_ms": _percentile(post_latency, 0.99) * 1000,
+        "e2e_p50_ms": _percentile(e2e, 0.50) * 1000,
+        "e2e_p99_ms": _percentile(e2e, 0.99) * 1000,
+        **{f"handler_{k}": v for k, v in handler.stats().items()},
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Webhook throughput/latency bench")
+    ap.add_argument("--updates", type=int, default=2000)
+    ap.add_argument("--concurrency", type=int, default=50)
+    ap.add_argument("--workers", type=int, default=8)
+    ap.add_argument("--port", type=int, default=8089)
+    ap.add_argument("--handler-delay", type=float, default=0.0, help="имитация работы хендлера, сек")
+    args = ap.parse_args()
+    res = asyncio.run(bench(args.updates, args.concurrency, args.workers, args.port, args.handler_delay))
+    for k, v in res.items():
+        print(f"{k:>22}: {v:.2f}" if isinstance(v, float) else f"{k:>22}: {v}")
+
+
+if __name__ == "__main__":
+    main()